@@ -7,6 +7,109 @@ import Class from "../models/Class.js";
 import Student from "../models/Student.js";
 import Submission from "../models/Submission.js";
 
+const parsedConcurrency = Number.parseInt(process.env.GRADING_CONCURRENCY, 10);
+const GRADING_CONCURRENCY = Math.max(1, Number.isNaN(parsedConcurrency) ? 4 : parsedConcurrency);
+
+const GRADING_MAX_RETRIES = 3;
+const GRADING_BACKOFF_BASE_MS = 500;
+const GRADING_BACKOFF_MAX_MS = 10000;
+// Only responses that can succeed on a later attempt; a 500 from the grading backend is a deterministic failure
+const RETRYABLE_STATUSES = new Set([429, 502, 503, 504]);
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// Queues tasks so that at most `limit` run at once, across every caller sharing the limiter
+const createLimiter = (limit) => {
+  let active = 0;
+  const queue = [];
+
+  const next = () => {
+    if (active >= limit || queue.length === 0) return;
+    active++;
+    const { task, resolve, reject } = queue.shift();
+    task()
+      .then(resolve, reject)
+      .finally(() => {
+        active--;
+        next();
+      });
+  };
+
+  return (task) => new Promise((resolve, reject) => {
+    queue.push({ task, resolve, reject });
+    next();
+  });
+};
+
+// Shared by all submissions graded in this process, so the Python backend never sees
+// more than GRADING_CONCURRENCY requests from us at a time
+const limitGradingCall = createLimiter(GRADING_CONCURRENCY);
+
+// Retry-After is either a number of seconds or an HTTP date
+const parseRetryAfter = (value) => {
+  if (!value) return null;
+  const seconds = Number(value);
+  if (Number.isFinite(seconds) && seconds >= 0) return seconds * 1000;
+  const date = Date.parse(value);
+  return Number.isNaN(date) ? null : Math.max(0, date - Date.now());
+};
+
+// Posts to the Python grading backend, retrying rate limits, unavailable upstreams and network errors.
+// The server's Retry-After is honoured as given; otherwise exponential backoff with full jitter.
+const postToGradingBackend = async (path, payload, headers = {}) => {
+  for (let attempt = 0; ; attempt++) {
+    try {
+      return await limitGradingCall(() => axios.post(
+        `${process.env.GRADIA_PYTHON_BACKEND_URL}${path}`,
+        payload,
+        {
+          headers: {
+            ...headers,
+            "x-api-key": process.env.GRADIA_API_KEY,
+          },
+        }
+      ));
+    } catch (err) {
+      const status = err.response?.status;
+      const retryable = status ? RETRYABLE_STATUSES.has(status) : Boolean(err.request);
+      if (!retryable || attempt >= GRADING_MAX_RETRIES) throw err;
+
+      const retryAfter = parseRetryAfter(err.response?.headers?.["retry-after"]);
+      const delay = retryAfter ?? Math.min(
+        Math.random() * GRADING_BACKOFF_BASE_MS * 2 ** attempt,
+        GRADING_BACKOFF_MAX_MS
+      );
+
+      await sleep(delay);
+    }
+  }
+};
+
+// Retrieves the reference material of each written question once, at publish time, so grading its answers
+// reuses it instead of searching the class material for every student
+const prepareTestQuestions = async (test) => {
+  try {
+    const questions = test.questions
+      .filter((question) => question.type !== "coding")
+      .map((question) => ({
+        question_id: question._id.toString(),
+        question: question.questionText,
+        max_mark: question.maxMarks,
+        rubrics: question.rubric ?? null,
+      }));
+    if (questions.length === 0) return;
+
+    const response = await postToGradingBackend("/api/grading/prepare", {
+      bucket_name: test.classAssignment,
+      questions,
+    });
+    console.log(`Prepared ${response.data.prepared.length} questions for test ${test._id}`);
+  } catch (err) {
+    // Grading still works without it, retrieving each question on first use
+    console.error(`Preparing questions for test ${test._id} failed:`, err.message);
+  }
+};
+
 export const gradingSubmission = async (submissionId) => {
   const submission = await Submission.findById(submissionId);
   if (!submission) throw new Error("Submission not found");
@@ -15,46 +118,76 @@ export const gradingSubmission = async (submissionId) => {
   if (!test) throw new Error("Test not found");
 
   const classId = test.classAssignment;
-  let totalScore = 0;
-  const gradedAnswers = [];
+  const gradingStart = Date.now();
+
+  const questionFor = (ans) => test.questions.find(q => q._id.toString() === ans.questionId);
+
+  // Every handwritten page of the submission is OCRed in one extract-batch call, alongside the test-case runs
+  const handwrittenAnswers = submission.answers.filter((ans) => questionFor(ans)?.type === "handwritten");
+  const ocrTexts = (async () => {
+    const texts = new Map();
+
+    // A missing or malformed upload fails only its own answer, not the whole batch
+    const pages = [];
+    handwrittenAnswers.forEach((ans) => {
+      const data = typeof ans.fileUrl === "string" ? ans.fileUrl.split(",")[1] : undefined;
+      const image = data ? Buffer.from(data, "base64") : null;
+      if (!image?.length) {
+        console.error(`OCR skipped for question ${ans.questionId}: no image data URL uploaded`);
+        return;
+      }
+      pages.push({ ans, image });
+    });
+    if (pages.length === 0) return texts;
+
+    try {
+      const formData = new FormData();
+      pages.forEach(({ image }, index) => {
+        formData.append("files", image, {
+          filename: `page-${index + 1}.jpg`,
+          contentType: "image/jpeg",
+        });
+      });
+
+      // Buffered so the multipart body can be re-sent on retry
+      const response = await postToGradingBackend(
+        "/api/ocr/extract-batch",
+        formData.getBuffer(),
+        formData.getHeaders()
+      );
+      response.data.pages.forEach((page, index) => {
+        if (page.error) {
+          console.error(`OCR failed for question ${pages[index].ans.questionId}:`, page.error);
+        } else {
+          texts.set(pages[index].ans, page.extracted_text ?? "");
+        }
+      });
+    } catch (err) {
+      console.error(`OCR failed for submission ${submissionId}:`, err.message);
+    }
+    return texts;
+  })();
 
-  for (const ans of submission.answers) {
-    const question = test.questions.find(q => q._id.toString() === ans.questionId);
-    if (!question) continue;
+  // Runs test cases for an answer, picks up its OCR text and builds the item the grade-batch call will grade
+  const prepareAnswer = async (ans) => {
+    const question = questionFor(ans);
+    if (!question) return null;
 
-    let score = 0;
-    let feedback = "";
+    const prepared = { ans, question, item: null };
 
-    if (question.type === "typed") {
-      try {
-        const gradingPayload = {
+    try {
+      if (question.type === "typed") {
+        prepared.item = {
+          type: "typed",
+          question_id: question._id.toString(),
           question: question.questionText,
-          student_answer: ans.answerText,
+          student_answer: ans.answerText ?? "",
           max_mark: question.maxMarks,
-          rubric: question.rubric ?? null,
-          bucket_name: classId,
+          rubrics: question.rubric ?? null,
         };
-        
-        const response = await axios.post(
-          `${process.env.GRADIA_PYTHON_BACKEND_URL}/api/grading/grade-answer`,
-          gradingPayload,
-          {
-            headers: {
-              "x-api-key": process.env.GRADIA_API_KEY,
-            },
-          }
-        );
-
-        const { grade, feedback: fb, reference } = response.data;
-        score = grade;
-        feedback = `${fb}${reference ? ` \nReference: ${reference}` : ""}`;
-      } catch (err) {
-        console.error(`Grading failed for typed question ${ans.questionId}:`, err.message);
       }
-    }
 
-    else if (question.type === "coding") {
-      try {
+      else if (question.type === "coding") {
         const source_code = ans.codeAnswer;
         const language = ans.codingLanguage;
 
@@ -69,111 +202,109 @@ export const gradingSubmission = async (submissionId) => {
           test_cases,
         };
 
-        const testCaseResponse = await axios.post(
-          `${process.env.GRADIA_PYTHON_BACKEND_URL}/api/code-eval/submit`,
-          codingPayload,
-          {
-            headers: {
-              "x-api-key": process.env.GRADIA_API_KEY,
-            },
-          }
-        );
+        const testCaseResponse = await postToGradingBackend("/api/code-eval/submit", codingPayload);
 
-        const { passed_test_cases, total_test_cases } = testCaseResponse.data;
+        prepared.testCases = testCaseResponse.data;
+        prepared.item = {
+          type: "coding",
+          question: question.questionText,
+          student_code: source_code ?? "",
+          max_mark: question.maxMarks / 2,
+        };
+      }
 
-        const perTestMark = question.maxMarks / total_test_cases;
-        const testCaseScore = Math.round(perTestMark * passed_test_cases);
+      else if (question.type === "handwritten") {
+        const texts = await ocrTexts;
+        if (!texts.has(ans)) throw new Error("No OCR text for this answer");
 
-        const codeGradingPayload = {
+        prepared.item = {
+          type: "handwritten",
+          question_id: question._id.toString(),
           question: question.questionText,
-          student_code: source_code,
-          max_mark: question.maxMarks / 2,
+          student_answer: texts.get(ans),
+          max_mark: question.maxMarks,
+          rubrics: question.rubric ?? null,
         };
-    
-        const codeGradingResponse = await axios.post(
-          `${process.env.GRADIA_PYTHON_BACKEND_URL}/api/grading/grade-code`,
-          codeGradingPayload,
-          {
-            headers: {
-              "x-api-key": process.env.GRADIA_API_KEY,
-            },
-          }
-        );
-    
-        const { grade: codeScore, feedback: codeFeedback } = codeGradingResponse.data;
-    
-        if (passed_test_cases === total_test_cases) {
-          score = testCaseScore;
-        } else {
-          const halfScore = question.maxMarks / 2;
-          const scaledTestCaseScore = (testCaseScore / question.maxMarks) * halfScore;
-          score = Math.round(scaledTestCaseScore + codeScore);
-        }
-    
-        feedback = `${passed_test_cases}/${total_test_cases} test cases passed.\nCode Feedback: ${codeFeedback}`;
-      } catch (err) {
-        console.error(`Grading failed for coding question ${ans.questionId}:`, err.message);
       }
+    } catch (err) {
+      console.error(`Grading failed for ${question.type} question ${ans.questionId}:`, err.message);
     }
 
-    else if (question.type === "handwritten") {
-      try {
-        const base64Data = ans.fileUrl.split(",")[1]; 
-        const imageBuffer = Buffer.from(base64Data, "base64");
+    return prepared;
+  };
+
+  const preparedAnswers = (await Promise.all(submission.answers.map(prepareAnswer))).filter(Boolean);
+  const batch = preparedAnswers.filter((prepared) => prepared.item);
+
+  // One request grades every answer of the submission, sharing the class material index.
+  // Answers the backend could not grade because the LLM was unavailable come back with retry_after;
+  // only those are sent again, so the grades that did succeed are kept.
+  const results = new Map();
+  let pending = batch;
+  for (let attempt = 0; pending.length > 0; attempt++) {
+    try {
+      const response = await postToGradingBackend("/api/grading/grade-batch", {
+        bucket_name: classId,
+        items: pending.map((prepared) => prepared.item),
+      });
+      const batchResults = response.data.results ?? [];
+      pending.forEach((prepared, index) => results.set(prepared, batchResults[index]));
+    } catch (err) {
+      console.error(`Batch grading failed for submission ${submissionId}:`, err.message);
+      break;
+    }
 
-        const formData = new FormData();
-        formData.append("file", imageBuffer, {
-          filename: "handwritten.jpg",
-          contentType: "image/jpeg",
-        });
+    const retryable = pending.filter((prepared) => results.get(prepared)?.retry_after != null);
+    if (retryable.length === 0 || attempt >= GRADING_MAX_RETRIES) break;
 
-        const ocrResponse = await axios.post(
-          `${process.env.GRADIA_PYTHON_BACKEND_URL}/api/ocr/extract-text`,
-          formData,
-          {
-            headers: {
-              ...formData.getHeaders(),
-              "x-api-key": process.env.GRADIA_API_KEY,
-            },
-          }
-        );
+    const retryAfter = Math.max(...retryable.map((prepared) => results.get(prepared).retry_after));
+    await sleep(retryAfter * 1000);
+    pending = retryable;
+  }
 
-        const extractedText = ocrResponse.data.extracted_text;
+  const gradedAnswers = preparedAnswers.map((prepared) => {
+    const { ans, question } = prepared;
+    const result = results.get(prepared);
 
-        const gradingPayload = {
-          question: question.questionText,
-          student_answer: extractedText,
-          max_mark: question.maxMarks,
-          rubric: question.rubric ?? null,
-          bucket_name: classId,
-        };
+    let score = 0;
+    let feedback = "";
+
+    if (result?.error) {
+      console.error(`Grading failed for ${question.type} question ${ans.questionId}:`, result.error);
+    }
 
-        const gradingResponse = await axios.post(
-          `${process.env.GRADIA_PYTHON_BACKEND_URL}/api/grading/grade-answer`,
-          gradingPayload,
-          {
-            headers: {
-              "x-api-key": process.env.GRADIA_API_KEY,
-            },
-          }
-        );
-
-        const { grade, feedback: fb, reference } = gradingResponse.data;
-        score = grade;
-        feedback = `${fb}${reference ? ` \nReference: ${reference}` : ""}`;
-      } catch (err) {
-        console.error(`Grading failed for handwritten question ${ans.questionId}:`, err.message);
+    else if (result && question.type === "coding") {
+      const { passed_test_cases, total_test_cases } = prepared.testCases;
+      const { grade: codeScore, feedback: codeFeedback } = result;
+
+      const perTestMark = question.maxMarks / total_test_cases;
+      const testCaseScore = Math.round(perTestMark * passed_test_cases);
+
+      if (passed_test_cases === total_test_cases) {
+        score = testCaseScore;
+      } else {
+        const halfScore = question.maxMarks / 2;
+        const scaledTestCaseScore = (testCaseScore / question.maxMarks) * halfScore;
+        score = Math.round(scaledTestCaseScore + codeScore);
       }
+
+      feedback = `${passed_test_cases}/${total_test_cases} test cases passed.\nCode Feedback: ${codeFeedback}`;
     }
 
-    totalScore += score;
+    else if (result) {
+      const { grade, feedback: fb, reference } = result;
+      score = grade;
+      feedback = `${fb}${reference ? ` \nReference: ${reference}` : ""}`;
+    }
 
-    gradedAnswers.push({
+    return {
       ...ans,
       score,
       feedback,
-    });
-  }
+    };
+  });
+
+  const totalScore = gradedAnswers.reduce((total, ans) => total + ans.score, 0);
 
   submission.answers = gradedAnswers;
   submission.totalScore = totalScore;
@@ -181,6 +312,15 @@ export const gradingSubmission = async (submissionId) => {
 
   await submission.save();
 
+  // Answers whose test cases, OCR or grading failed were saved with a score of 0
+  const failedCount = preparedAnswers.filter((prepared) => !results.get(prepared) || results.get(prepared).error).length;
+  const elapsed = Date.now() - gradingStart;
+  if (failedCount === 0) {
+    console.log(`Graded submission ${submissionId} (${gradedAnswers.length} answers) in ${elapsed}ms`);
+  } else {
+    console.error(`Grading incomplete for submission ${submissionId}: ${failedCount} of ${gradedAnswers.length} answers failed after ${elapsed}ms`);
+  }
+
   return { message: "Grading complete", submissionId };
 };
 
@@ -220,6 +360,9 @@ export const createTest = async (req, res) => {
       { new: true }
     );
 
+    // Not awaited: the teacher does not wait on it, and it only logs if it fails
+    if (!newTest.isDraft) prepareTestQuestions(newTest);
+
     res.status(201).json({ success: true, message: "Test created successfully!", test: newTest });
   } catch (error) {
     console.error("Error publishing test:", error);
@@ -1,7 +1,12 @@
-from flask import Flask
+import time
+from flask import Flask, g, request
 from config import Config
 
+# Filled in by create_app; served by /api/status next to the provider load times
+startup_report = {}
+
 def create_app():
+    started = time.perf_counter()
     app = Flask(__name__)
     app.config.from_object(Config)
 
@@ -17,4 +22,27 @@ def create_app():
     app.register_blueprint(ocr_bp)
     app.register_blueprint(code_eval_bp)
 
+    from app.utils.metrics import metrics, start_request_timing, server_timing_header, SERVER_TIMING_HEADERS
+
+    @app.before_request
+    def start_timing():
+        g.request_started = time.perf_counter()
+        start_request_timing()
+
+    @app.after_request
+    def record_timing(response):
+        started = g.get("request_started")
+        if started is not None:
+            metrics.observe("gradia_request_seconds", time.perf_counter() - started, endpoint=request.endpoint or "unknown", status=response.status_code)
+        if SERVER_TIMING_HEADERS:
+            response.headers["Server-Timing"] = server_timing_header()
+        return response
+
+    startup_report["create_app_seconds"] = round(time.perf_counter() - started, 3)
+
+    from app.services.providers import preload_models, startup_timings
+    preload_models()
+    startup_report["ready_seconds"] = round(time.perf_counter() - started, 3)
+    print(f"App ready in {startup_report['ready_seconds']}s (create_app {startup_report['create_app_seconds']}s, preloaded {startup_timings or 'nothing'})")
+
     return app
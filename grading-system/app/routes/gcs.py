@@ -1,13 +1,18 @@
-from flask import Blueprint, request, jsonify, send_file
+import os
+from urllib.parse import quote
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from app.utils.auth_check import require_api_key
 from app.services.gcs_service import (
     create_bucket, 
     delete_bucket,
     list_pdfs, 
+    list_pdfs_page,
     upload_file, 
     delete_file,
-    download_pdf
+    open_blob_stream
 )
+from app.services.index_cache import course_index_cache
+from app.services.grading_service import refresh_course_index
 
 gcs_bp = Blueprint('gcs', __name__, url_prefix="/api/gcs")
 
@@ -34,6 +39,7 @@ def delete_gcs_bucket_endpoint():
         return jsonify({"error": "Missing required field: bucket_name"}), 400
     try:
         delete_bucket(bucket_name)
+        course_index_cache.invalidate(bucket_name)
         return jsonify({"message": f"Bucket '{bucket_name}' deleted successfully."})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -44,11 +50,19 @@ def delete_gcs_bucket_endpoint():
 def list_pdfs_in_bucket_endpoint():
     data = request.get_json()
     bucket_name = data.get("bucket_name")
+    prefix = data.get("prefix")
+    page_token = data.get("page_token")
+    page_size = data.get("page_size")
     if not bucket_name:
         return jsonify({"error": "Missing required field: bucket_name"}), 400
+    if page_size is not None and (isinstance(page_size, bool) or not isinstance(page_size, int) or page_size <= 0):
+        return jsonify({"error": "page_size must be a positive integer"}), 400
     try:
-        pdf_files = list_pdfs(bucket_name)
-        return jsonify({"pdf_files": pdf_files})
+        # Without paging arguments the whole (prefix-filtered) listing comes back, as before
+        if page_token is None and page_size is None:
+            return jsonify({"pdf_files": list_pdfs(bucket_name, prefix)})
+        pdf_files, next_page_token = list_pdfs_page(bucket_name, prefix, page_token, page_size)
+        return jsonify({"pdf_files": pdf_files, "next_page_token": next_page_token})
     except Exception as e:
         return jsonify({"error": f"Failed to list PDFs: {str(e)}"}), 500
 
@@ -64,6 +78,7 @@ def upload_file_to_bucket_endpoint():
         return jsonify({"error": "Missing required field: bucket_name"}), 400
     try:
         upload_file(bucket_name, file)
+        refresh_course_index(bucket_name)
         return jsonify({"message": f"File '{file.filename}' uploaded successfully to bucket '{bucket_name}'."})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -79,6 +94,7 @@ def delete_file_from_bucket_endpoint():
         return jsonify({"error": "Missing required fields: bucket_name, file_name"}), 400
     try:
         delete_file(bucket_name, file_name)
+        refresh_course_index(bucket_name)
         return jsonify({"message": f"File '{file_name}' deleted successfully from bucket '{bucket_name}'."})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -94,5 +110,13 @@ def download_file_from_gcs():
     if not bucket_name or not file_name:
         return jsonify({"error": "Missing required fields: bucket_name, file_name"}), 400
 
-    local_path = download_pdf(bucket_name, file_name)
-    return send_file(local_path, as_attachment=True)
+    try:
+        blob, chunks = open_blob_stream(bucket_name, file_name)
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+
+    # Piped to the client chunk by chunk instead of being written to disk first
+    headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(os.path.basename(file_name))}"}
+    if blob.size is not None:
+        headers["Content-Length"] = str(blob.size)
+    return Response(stream_with_context(chunks), mimetype=blob.content_type or "application/pdf", headers=headers)
@@ -1,9 +1,25 @@
 from flask import Blueprint, request, jsonify
 from app.utils.auth_check import require_api_key
-from app.services.grading_service import grade_answer, grade_code
+from app.services.grading_service import grade_answer, grade_code, grade_batch, validate_batch_request, prepare_questions, validate_prepare_request
+from app.services.prepared_questions import prepared_questions
+from app.services.context_cache import context_cache
+from app.services.llm_cache import response_cache
+from app.services.grading_jobs import job_queue, validate_job
+from app.services.job_queue import validate_callback_url
+from app.services.llm_client import LLMUnavailableError, llm_client
 
 grading_bp = Blueprint('grading', __name__, url_prefix="/api/grading")
 
+@grading_bp.errorhandler(LLMUnavailableError)
+def llm_unavailable(e):
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = str(max(1, int(e.retry_after + 0.5)))
+    return response, 503
+
+@grading_bp.before_app_request
+def start_job_workers():
+    job_queue.start()
+
 @grading_bp.route('/grade-answer', methods=['POST'])
 @require_api_key
 def grade_answer_endpoint():
@@ -13,6 +29,8 @@ def grade_answer_endpoint():
     max_mark = data.get("max_mark")
     bucket_name = data.get("bucket_name")
     rubrics = data.get("rubrics")
+    force = bool(data.get("force"))
+    question_id = data.get("question_id")
 
     if not question or not student_answer or max_mark is None or not bucket_name:
         return jsonify({"error": "Missing required fields: question, student_answer, max_mark, bucket_name"}), 400
@@ -20,7 +38,7 @@ def grade_answer_endpoint():
     if not isinstance(max_mark, (int, float)) or max_mark <= 0:
         return jsonify({"error": "max_mark must be a positive integer"}), 400
     
-    grading_result = grade_answer(question, student_answer, max_mark, bucket_name, rubrics)
+    grading_result = grade_answer(question, student_answer, max_mark, bucket_name, rubrics, force=force, question_id=question_id)
     return jsonify(grading_result)
 
 
@@ -31,6 +49,7 @@ def grade_code_endpoint():
     question = data.get("question")
     student_code = data.get("student_code")
     max_mark = data.get("max_mark")
+    force = bool(data.get("force"))
 
     if not question or not student_code or max_mark is None:
         return jsonify({"error": "Missing required fields: question, student_code, max_mark"}), 400
@@ -38,5 +57,78 @@ def grade_code_endpoint():
     if not isinstance(max_mark, (int, float)) or max_mark <= 0:
         return jsonify({"error": "max_mark must be a positive number"}), 400
     
-    grading_result = grade_code(question, student_code, max_mark)
+    grading_result = grade_code(question, student_code, max_mark, force=force)
     return jsonify(grading_result)
+
+
+@grading_bp.route('/grade-batch', methods=['POST'])
+@require_api_key
+def grade_batch_endpoint():
+    data = request.get_json()
+    bucket_name = data.get("bucket_name")
+    items = data.get("items")
+    force = bool(data.get("force"))
+    pack = data.get("pack")
+
+    error = validate_batch_request(bucket_name, items, pack)
+    if error:
+        return jsonify({"error": error}), 400
+
+    results = grade_batch(bucket_name, items, force=force, pack=pack)
+    return jsonify({"results": results})
+
+
+@grading_bp.route('/prepare', methods=['POST'])
+@require_api_key
+def prepare_endpoint():
+    # Called when a test is published: retrieves each question's references once, for every answer to reuse
+    data = request.get_json(silent=True) or {}
+    bucket_name = data.get("bucket_name")
+    questions = data.get("questions")
+
+    error = validate_prepare_request(bucket_name, questions)
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        prepared = prepare_questions(bucket_name, questions)
+    except Exception as e:
+        return jsonify({"error": f"Failed to prepare questions: {str(e)}"}), 500
+    return jsonify({"prepared": prepared})
+
+
+@grading_bp.route('/cache-stats', methods=['GET'])
+@require_api_key
+def cache_stats_endpoint():
+    return jsonify({
+        **response_cache.stats(),
+        "llm": llm_client.stats(),
+        "prepared_questions": prepared_questions.stats(),
+        "gemini_context": context_cache.stats()
+    })
+
+
+@grading_bp.route('/jobs', methods=['POST'])
+@require_api_key
+def create_job_endpoint():
+    data = request.get_json(silent=True) or {}
+    kind = data.get("kind")
+    payload = data.get("payload")
+    callback_url = data.get("callback_url")
+
+    error = validate_job(kind, payload)
+    if not error and callback_url is not None:
+        error = validate_callback_url(callback_url)
+    if error:
+        return jsonify({"error": error}), 400
+
+    return jsonify(job_queue.enqueue(kind, payload, callback_url)), 202
+
+
+@grading_bp.route('/jobs/<job_id>', methods=['GET'])
+@require_api_key
+def get_job_endpoint(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' not found"}), 404
+    return jsonify(job)
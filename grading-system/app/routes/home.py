@@ -1,5 +1,14 @@
-from flask import Blueprint
+from flask import Blueprint, Response, jsonify
+from app import startup_report
 from app.utils.auth_check import require_api_key
+from app.utils.metrics import metrics
+from app.services.providers import provider_status
+from app.services.llm_cache import response_cache
+from app.services.llm_client import llm_client
+from app.services.ocr_service import ocr_cache
+from app.services.prepared_questions import prepared_questions
+from app.services.context_cache import context_cache
+from app.services.grading_service import embedding_cache_stats
 
 home_bp = Blueprint('home', __name__, url_prefix="/api")
 
@@ -7,3 +16,38 @@ home_bp = Blueprint('home', __name__, url_prefix="/api")
 @require_api_key
 def home():
     return "The Gradia Grading System is up and running :)"
+
+
+@home_bp.route('/status', methods=['GET'])
+@require_api_key
+def status():
+    return jsonify({"startup": startup_report, "providers": provider_status()})
+
+
+def cache_samples():
+    # Cache and Gemini counters kept by the services themselves, read at scrape time
+    samples = []
+    caches = {
+        "llm": response_cache.stats(),
+        "ocr": ocr_cache.stats(),
+        "embedding": embedding_cache_stats(),
+        "prepared_questions": prepared_questions.stats(),
+        "gemini_context": context_cache.stats()
+    }
+    for cache, stats in caches.items():
+        samples.append(("gradia_cache_hits_total", "counter", {"cache": cache}, stats["hits"]))
+        samples.append(("gradia_cache_misses_total", "counter", {"cache": cache}, stats["misses"]))
+
+    llm = llm_client.stats()
+    samples.append(("gradia_llm_requests_total", "counter", {}, llm["requests"]))
+    samples.append(("gradia_llm_tokens_total", "counter", {"kind": "prompt"}, llm["prompt_tokens"]))
+    samples.append(("gradia_llm_tokens_total", "counter", {"kind": "cached"}, llm["cached_tokens"]))
+    samples.append(("gradia_llm_tokens_total", "counter", {"kind": "output"}, llm["output_tokens"]))
+    samples.append(("gradia_llm_breaker_open", "gauge", {}, int(llm["breaker"] != "closed")))
+    return samples
+
+
+@home_bp.route('/metrics', methods=['GET'])
+@require_api_key
+def metrics_endpoint():
+    return Response(metrics.render(cache_samples()), mimetype="text/plain; version=0.0.4")
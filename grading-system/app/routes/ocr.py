@@ -1,9 +1,6 @@
-import os
-import json
-import tempfile
 from flask import Blueprint, request, jsonify
 from app.utils.auth_check import require_api_key
-from app.services.ocr_service import extract_handwritten_text
+from app.services.ocr_service import extract_handwritten_text, extract_handwritten_texts, ocr_cache, MAX_OCR_IMAGES
 
 ocr_bp = Blueprint('ocr', __name__, url_prefix="/api/ocr")
 
@@ -16,19 +13,39 @@ def extract_handwritten_text_endpoint():
     if file.filename == "":
         return jsonify({"error": "No selected file"}), 400
 
-    temp_file = None
     try:
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1])
-        temp_file.close()
-        file.save(temp_file.name)
-        result = extract_handwritten_text(temp_file.name)
-        if os.path.exists(temp_file.name):
-            os.unlink(temp_file.name)
-        return jsonify(json.loads(result))
+        result = extract_handwritten_text(file.read())
     except Exception as e:
-        if temp_file and os.path.exists(temp_file.name):
-            try:
-                os.unlink(temp_file.name)
-            except PermissionError:
-                print(f"Warning: Could not delete temporary file {temp_file.name}: {str(e)}")
         return jsonify({"error": f"Failed to process handwritten text: {str(e)}"}), 500
+
+    if result.get("error"):
+        return jsonify({"error": f"Failed to process handwritten text: {result['error']}"}), 500
+    return jsonify(result)
+
+
+@ocr_bp.route('/extract-batch', methods=['POST'])
+@require_api_key
+def extract_batch_endpoint():
+    # Pages of a handwritten script, one image per "files" part, answered in upload order
+    files = [file for file in request.files.getlist("files") if file.filename]
+    if not files:
+        return jsonify({"error": "No files in the request"}), 400
+    if len(files) > MAX_OCR_IMAGES:
+        return jsonify({"error": f"A batch can contain at most {MAX_OCR_IMAGES} images"}), 400
+
+    try:
+        results = extract_handwritten_texts([file.read() for file in files])
+    except Exception as e:
+        return jsonify({"error": f"Failed to process handwritten text: {str(e)}"}), 500
+
+    pages = [{"page": number, "filename": file.filename, **result} for number, (file, result) in enumerate(zip(files, results), 1)]
+    return jsonify({
+        "pages": pages,
+        "extracted_text": "\n".join(page["extracted_text"] for page in pages if not page.get("error"))
+    })
+
+
+@ocr_bp.route('/cache-stats', methods=['GET'])
+@require_api_key
+def cache_stats_endpoint():
+    return jsonify(ocr_cache.stats())
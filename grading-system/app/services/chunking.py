@@ -0,0 +1,303 @@
+import os
+import re
+import json
+import numpy as np
+
+# all-MiniLM-L6-v2 truncates input at 256 word pieces, including its two special tokens
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "240"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+
+LINE_PATTERN = re.compile(r"[^\n]*\n?")
+SENTENCE_PATTERN = re.compile(r"\S(?:[^.!?]|[.!?](?![\s\"')\]]|$))*(?:[.!?]+[\"')\]]*|$)")
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+NUMBERED_HEADING = re.compile(
+    r"^(?:\d+(?:\.\d+)*\.?|[IVXLC]+\.|(?i:chapter|section|unit|module|part|lecture|topic)\s+[\w.]+[:.)-]?)\s+\S"
+)
+
+def estimate_tokens(text):
+    # Word-piece tokenizers split long and rare words, so long words count double
+    return sum(2 if len(token) > 8 else 1 for token in TOKEN_PATTERN.findall(text))
+
+def is_heading(line):
+    if len(line) > 80 or line[-1] in ".,;!?":
+        return False
+    if NUMBERED_HEADING.match(line):
+        return True
+    letters = [c for c in line if c.isalpha()]
+    if letters and all(c.isupper() for c in letters) and len(letters) > 2:
+        return True
+    words = line.split()
+    return len(words) <= 6 and line[0].isupper() and not line.endswith(":")
+
+def _sentences(text, start, end):
+    for match in SENTENCE_PATTERN.finditer(text, start, end):
+        sentence = " ".join(match.group().split())
+        if sentence:
+            yield "sentence", sentence, match.start()
+
+def split_page(text):
+    # Yields ("heading" | "sentence", text, offset) in reading order; offsets index into the page text
+    block_start = block_end = None
+    previous_ends_block = True
+
+    for match in LINE_PATTERN.finditer(text):
+        line = match.group().strip()
+        if not match.group():
+            break
+
+        if not line:
+            if block_start is not None:
+                yield from _sentences(text, block_start, block_end)
+                block_start = None
+            previous_ends_block = True
+            continue
+
+        # A heading stands on its own line after a finished sentence, not in the middle of a wrapped one
+        if previous_ends_block and is_heading(line):
+            if block_start is not None:
+                yield from _sentences(text, block_start, block_end)
+                block_start = None
+            yield "heading", line, match.start() + match.group().index(line[0])
+            previous_ends_block = True
+            continue
+
+        if block_start is None:
+            block_start = match.start()
+        block_end = match.end()
+        previous_ends_block = line[-1] in ".!?:"
+
+    if block_start is not None:
+        yield from _sentences(text, block_start, block_end)
+
+def _split_long_sentence(sentence, offset, max_tokens):
+    tokens = estimate_tokens(sentence)
+    if tokens <= max_tokens:
+        yield sentence, offset, tokens
+        return
+
+    words = sentence.split(" ")
+    piece, piece_tokens, piece_offset, cursor = [], 0, offset, offset
+    for word in words:
+        word_tokens = estimate_tokens(word)
+        if piece and piece_tokens + word_tokens > max_tokens:
+            yield " ".join(piece), piece_offset, piece_tokens
+            piece, piece_tokens, piece_offset = [], 0, cursor
+        piece.append(word)
+        piece_tokens += word_tokens
+        cursor += len(word) + 1
+    if piece:
+        yield " ".join(piece), piece_offset, piece_tokens
+
+def chunk_pages(pages, source, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    # Every chunk's embedding text (heading, newline, sentences) stays within max_tokens, overlap included
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    heading = ""
+    budget = max_tokens
+
+    def make_chunk(sentences, page_number):
+        return {
+            "text": " ".join(sentence for sentence, _, _ in sentences),
+            "source": source,
+            "page": page_number,
+            "offset": sentences[0][1],
+            "heading": heading
+        }
+
+    def overlap_tail(sentences, room):
+        # The last whole sentences of the finished chunk, as many as fit the overlap and the room the next sentence leaves
+        tail, total = [], 0
+        for sentence in reversed(sentences):
+            if total + sentence[2] > min(overlap_tokens, room):
+                break
+            tail.insert(0, sentence)
+            total += sentence[2]
+        return tail
+
+    for page_number, page_text in pages:
+        current, current_tokens = [], 0
+        for kind, value, offset in split_page(page_text):
+            if kind == "heading":
+                if current:
+                    yield make_chunk(current, page_number)
+                current, current_tokens = [], 0
+                heading = value
+                budget = max(1, max_tokens - estimate_tokens(heading))
+                continue
+
+            for sentence in _split_long_sentence(value, offset, budget):
+                if current and current_tokens + sentence[2] > budget:
+                    yield make_chunk(current, page_number)
+                    current = overlap_tail(current, budget - sentence[2])
+                    current_tokens = sum(tokens for _, _, tokens in current)
+                current.append(sentence)
+                current_tokens += sentence[2]
+
+        # Chunks never span pages, so every citation points at a single page
+        if current:
+            yield make_chunk(current, page_number)
+
+class ChunkStore:
+    # Column store for chunk records: one text buffer with boundaries plus numpy metadata columns.
+    # ids are the vector index ids, kept in ascending order so lookups are a binary search.
+    def __init__(self, text="", bounds=None, source_ids=None, pages=None, offsets=None, heading_ids=None, sources=None, headings=None, ids=None):
+        self.text = text
+        self.bounds = bounds if bounds is not None else np.zeros(1, dtype=np.int64)
+        self.source_ids = source_ids if source_ids is not None else np.zeros(0, dtype=np.int32)
+        self.pages = pages if pages is not None else np.zeros(0, dtype=np.int32)
+        self.offsets = offsets if offsets is not None else np.zeros(0, dtype=np.int64)
+        self.heading_ids = heading_ids if heading_ids is not None else np.zeros(0, dtype=np.int32)
+        self.sources = sources or []
+        self.headings = headings or []
+        self.ids = ids if ids is not None else np.arange(len(self.pages), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def rows_for_ids(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return rows[self.ids[rows] == ids]
+
+    def source_mask(self, source_names):
+        source_names = set(source_names)
+        wanted = [i for i, name in enumerate(self.sources) if name in source_names]
+        return np.isin(self.source_ids, wanted)
+
+    def select(self, mask):
+        # Keeps the masked rows in order and drops source and heading names no row uses any more
+        rows = np.flatnonzero(mask)
+        texts = [self.chunk_text(i) for i in rows]
+        bounds = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in texts], out=bounds[1:])
+
+        used_sources, source_ids = np.unique(self.source_ids[rows], return_inverse=True)
+        heading_ids = self.heading_ids[rows]
+        used_headings, compact_headings = np.unique(heading_ids[heading_ids >= 0], return_inverse=True)
+        new_heading_ids = np.full(len(rows), -1, dtype=np.int32)
+        new_heading_ids[heading_ids >= 0] = compact_headings
+
+        return ChunkStore(
+            "".join(texts),
+            bounds,
+            source_ids.astype(np.int32),
+            self.pages[rows],
+            self.offsets[rows],
+            new_heading_ids,
+            [self.sources[i] for i in used_sources],
+            [self.headings[i] for i in used_headings],
+            self.ids[rows]
+        )
+
+    def extend(self, other):
+        sources = {name: i for i, name in enumerate(self.sources)}
+        headings = {name: i for i, name in enumerate(self.headings)}
+        source_map = np.array([sources.setdefault(name, len(sources)) for name in other.sources], dtype=np.int32)
+        heading_map = np.array([headings.setdefault(name, len(headings)) for name in other.headings], dtype=np.int32)
+        other_headings = np.where(
+            other.heading_ids >= 0,
+            heading_map[np.maximum(other.heading_ids, 0)] if len(heading_map) else -1,
+            -1
+        )
+
+        return ChunkStore(
+            self.text + other.text,
+            np.concatenate([self.bounds, other.bounds[1:] + self.bounds[-1]]),
+            np.concatenate([self.source_ids, source_map[other.source_ids] if len(other) else other.source_ids]).astype(np.int32),
+            np.concatenate([self.pages, other.pages]).astype(np.int32),
+            np.concatenate([self.offsets, other.offsets]).astype(np.int64),
+            np.concatenate([self.heading_ids, other_headings]).astype(np.int32),
+            list(sources),
+            list(headings),
+            np.concatenate([self.ids, other.ids]).astype(np.int64)
+        )
+
+    def chunk_text(self, i):
+        return self.text[self.bounds[i]:self.bounds[i + 1]]
+
+    def heading(self, i):
+        heading_id = self.heading_ids[i]
+        return self.headings[heading_id] if heading_id >= 0 else ""
+
+    def embedding_text(self, i):
+        heading = self.heading(i)
+        return f"{heading}\n{self.chunk_text(i)}" if heading else self.chunk_text(i)
+
+    def record(self, i):
+        return {
+            "text": self.chunk_text(i),
+            "source": self.sources[self.source_ids[i]],
+            "page": int(self.pages[i]),
+            "offset": int(self.offsets[i]),
+            "heading": self.heading(i)
+        }
+
+    def save(self, directory):
+        np.savez(
+            os.path.join(directory, "chunks.npz"),
+            bounds=self.bounds,
+            source_ids=self.source_ids,
+            pages=self.pages,
+            offsets=self.offsets,
+            heading_ids=self.heading_ids,
+            ids=self.ids
+        )
+        with open(os.path.join(directory, "chunks.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.text)
+        with open(os.path.join(directory, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump({"sources": self.sources, "headings": self.headings}, f)
+
+    @classmethod
+    def load(cls, directory):
+        columns = np.load(os.path.join(directory, "chunks.npz"))
+        with open(os.path.join(directory, "chunks.txt"), "r", encoding="utf-8", newline="") as f:
+            text = f.read()
+        with open(os.path.join(directory, "chunks.json"), "r", encoding="utf-8") as f:
+            names = json.load(f)
+        return cls(
+            text,
+            columns["bounds"],
+            columns["source_ids"],
+            columns["pages"],
+            columns["offsets"],
+            columns["heading_ids"],
+            names["sources"],
+            names["headings"],
+            columns["ids"]
+        )
+
+class ChunkStoreBuilder:
+    def __init__(self):
+        self._texts = []
+        self._lengths = []
+        self._source_ids = []
+        self._pages = []
+        self._offsets = []
+        self._heading_ids = []
+        self._sources = {}
+        self._headings = {}
+
+    def append(self, chunk):
+        self._texts.append(chunk["text"])
+        self._lengths.append(len(chunk["text"]))
+        self._source_ids.append(self._sources.setdefault(chunk["source"], len(self._sources)))
+        self._pages.append(chunk["page"])
+        self._offsets.append(chunk.get("offset", 0))
+        heading = chunk.get("heading") or ""
+        self._heading_ids.append(self._headings.setdefault(heading, len(self._headings)) if heading else -1)
+
+    def build(self, first_id=0):
+        bounds = np.zeros(len(self._lengths) + 1, dtype=np.int64)
+        np.cumsum(self._lengths, out=bounds[1:])
+        return ChunkStore(
+            "".join(self._texts),
+            bounds,
+            np.asarray(self._source_ids, dtype=np.int32),
+            np.asarray(self._pages, dtype=np.int32),
+            np.asarray(self._offsets, dtype=np.int64),
+            np.asarray(self._heading_ids, dtype=np.int32),
+            list(self._sources),
+            list(self._headings),
+            np.arange(first_id, first_id + len(self._lengths), dtype=np.int64)
+        )
@@ -1,8 +1,20 @@
 import os
 import time
 import requests
+import threading
+from app.utils.metrics import stage, timed, increment
 
 JUDGE0_API_KEY = os.getenv("JUDGE0_API_KEY")
+JUDGE0_URL = os.getenv("JUDGE0_URL", "https://judge0-ce.p.rapidapi.com")
+# "judge0" sends code to the Judge0 API, "local" runs it in the sandboxed local worker pool
+CODE_EXECUTOR = os.getenv("CODE_EXECUTOR", "judge0")
+
+# Judge0 accepts at most 20 submissions per batch request
+JUDGE0_BATCH_SIZE = 20
+POLL_INITIAL_INTERVAL = 0.2
+POLL_MAX_INTERVAL = 2.0
+POLL_BACKOFF = 1.5
+RESULT_FIELDS = 'token,status,stdout,stderr,compile_output,time,memory'
 
 HEADERS = {
     'X-RapidAPI-Key': JUDGE0_API_KEY,
@@ -101,48 +113,76 @@ def prepare_source_code(user_code, language):
     lang_config = LANGUAGE_CONFIGS[language]
     return lang_config['template'].format(user_code=user_code)
 
-def submit_code_to_judge0(source_code, language_id, stdin=''):
+def submit_batch_to_judge0(source_code, language_id, stdins):
     payload = {
-        'source_code': source_code,
-        'language_id': language_id,
-        'stdin': stdin,
-        'compile_output_only': False
+        'submissions': [
+            {
+                'source_code': source_code,
+                'language_id': language_id,
+                'stdin': stdin,
+                'compile_output_only': False
+            }
+            for stdin in stdins
+        ]
     }
-    
-    try:
-        response = requests.post(
-            "https://judge0-ce.p.rapidapi.com/submissions", 
-            json=payload, 
-            headers=HEADERS
 
-        )
+    try:
+        with stage("judge0_submit"):
+            response = requests.post(
+                f"{JUDGE0_URL}/submissions/batch",
+                params={'base64_encoded': 'false'},
+                json=payload,
+                headers=HEADERS
+            )
         response.raise_for_status()
-        token = response.json().get('token')
-        return token
+        tokens = [entry.get('token') for entry in response.json()]
     except requests.exceptions.RequestException as e:
         raise CodeSubmissionError(f"Submission failed: {str(e)}")
 
-def get_submission_result(token, timeout=30):
+    if len(tokens) != len(stdins):
+        raise CodeSubmissionError(f"Judge0 returned {len(tokens)} tokens for {len(stdins)} submissions")
+    return tokens
+
+def get_batch_results(tokens, timeout=30):
+    pending = [token for token in tokens if token]
+    results = {}
+    interval = POLL_INITIAL_INTERVAL
     start_time = time.time()
-    while time.time() - start_time < timeout:
+
+    while pending and time.time() - start_time < timeout:
+        increment("gradia_judge0_polls_total")
         try:
-            response = requests.get(
-                f"https://judge0-ce.p.rapidapi.com/submissions/{token}", 
-                headers=HEADERS
-            )
+            with stage("judge0_poll"):
+                response = requests.get(
+                    f"{JUDGE0_URL}/submissions/batch",
+                    params={
+                        'tokens': ','.join(pending),
+                        'base64_encoded': 'false',
+                        'fields': RESULT_FIELDS
+                    },
+                    headers=HEADERS
+                )
             response.raise_for_status()
-            result = response.json()
-            
-            # Check if processing is complete
-            status_id = result.get('status', {}).get('id')
-            
-            if status_id > 2: 
-                return result
-            
-            time.sleep(0.5)
+            submissions = response.json().get('submissions', [])
         except requests.exceptions.RequestException as e:
             raise CodeSubmissionError(f"Result retrieval failed: {str(e)}")
-    raise CodeSubmissionError("Submission processing timeout")
+
+        # Check which submissions have finished processing
+        finished = 0
+        for submission in submissions:
+            if submission and submission.get('status', {}).get('id', 0) > 2:
+                results[submission['token']] = submission
+                finished += 1
+
+        pending = [token for token in pending if token not in results]
+        if not pending:
+            break
+
+        # Poll quickly while results are arriving, back off while the queue is busy
+        interval = POLL_INITIAL_INTERVAL if finished else min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+        time.sleep(interval)
+
+    return results
 
 def parse_submission_result(result, expected_output):
     status = result.get('status', {})
@@ -172,6 +212,62 @@ def parse_submission_result(result, expected_output):
         'actual_output': stdout
     }
 
+class Judge0Executor:
+    def run(self, source_code, language, stdins):
+        language_id = LANGUAGE_CONFIGS[language]["id"]
+
+        tokens = []
+        outcomes = {}
+        for start in range(0, len(stdins), JUDGE0_BATCH_SIZE):
+            batch = stdins[start:start + JUDGE0_BATCH_SIZE]
+            try:
+                tokens.extend(submit_batch_to_judge0(source_code, language_id, batch))
+            except CodeSubmissionError as e:
+                tokens.extend([None] * len(batch))
+                for offset in range(len(batch)):
+                    outcomes[start + offset] = e
+
+        try:
+            results = get_batch_results(tokens)
+        except CodeSubmissionError as e:
+            results = {}
+            for position in range(len(tokens)):
+                outcomes.setdefault(position, e)
+
+        for position, token in enumerate(tokens):
+            if position in outcomes:
+                continue
+            if not token:
+                outcomes[position] = CodeSubmissionError("Submission was rejected by Judge0")
+            elif token not in results:
+                outcomes[position] = CodeSubmissionError("Submission processing timeout")
+            else:
+                outcomes[position] = results[token]
+
+        return [outcomes[position] for position in range(len(stdins))]
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if CODE_EXECUTOR == "local":
+                from app.services.local_executor import LocalExecutor
+                _executor = LocalExecutor()
+            elif CODE_EXECUTOR == "judge0":
+                _executor = Judge0Executor()
+            else:
+                raise CodeSubmissionError(f"Unknown CODE_EXECUTOR: {CODE_EXECUTOR}")
+        return _executor
+
+def warm_up_executor():
+    # Called from gunicorn's post_fork, so each worker's sandbox processes exist before its first submission
+    if CODE_EXECUTOR == "local":
+        get_executor().warm_up()
+
+@timed("code_eval")
 def submit_code(source_code, language, test_cases):
     try:
         language_config = LANGUAGE_CONFIGS.get(language)
@@ -179,21 +275,19 @@ def submit_code(source_code, language, test_cases):
             raise CodeSubmissionError(f"Unsupported language: {language}")
 
         prepared_source_code = prepare_source_code(source_code, language)
-        test_results = []
+        stdins = [str(test_case.get("input", "")) for test_case in test_cases]
+        increment("gradia_test_cases_total", len(stdins), executor=CODE_EXECUTOR)
+        with stage("code_execution"):
+            outcomes = get_executor().run(prepared_source_code, language, stdins)
 
-        for idx, test_case in enumerate(test_cases, 1):
+        test_results = []
+        for idx, (test_case, input_data, outcome) in enumerate(zip(test_cases, stdins, outcomes), 1):
             try:
-                input_data = str(test_case.get("input", ""))
-                expected_output = test_case.get("expected_output", "")
-
-                token = submit_code_to_judge0(
-                    prepared_source_code,
-                    language_config["id"],
-                    stdin=input_data,
-                )
+                if isinstance(outcome, Exception):
+                    raise outcome
 
-                result = get_submission_result(token)
-                parsed_result = parse_submission_result(result, expected_output)
+                expected_output = test_case.get("expected_output", "")
+                parsed_result = parse_submission_result(outcome, expected_output)
                 parsed_result.update(
                     {
                         "test_case_id": idx,
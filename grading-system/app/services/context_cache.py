@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from app.services.providers import get_genai_client
+from app.services.chunking import estimate_tokens
+from app.services.llm_client import generate_content, error_status
+from app.utils.sqlite_cache import SqliteCache
+from app.utils.metrics import stage, increment
+
+# Gemini context caching: the part of a grading prompt that is the same for every student answering a question
+# (rules, question, reference material, rubrics) is uploaded once as cached content, and each grade sends only
+# the rest. Cached tokens are billed at a fraction of the input price and skip most of the prefill.
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+# Gemini rejects cached content below the model's minimum size (4096 tokens for gemini-2.0-flash);
+# shorter prefixes are sent in full as before
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096"))
+# Reference material a cached prefix may carry; it cannot shrink with each answer's length the way a full prompt's does
+CONTEXT_CACHE_REFERENCE_TOKENS = int(os.getenv("CONTEXT_CACHE_REFERENCE_TOKENS", "6000"))
+# Chunks retrieved per question while caching is on. Five chunks of at most 240 tokens never reach the minimum;
+# this many fill the reference allowance above, and an uncached prompt still keeps only what fits its budget.
+CONTEXT_CACHE_RETRIEVAL_K = int(os.getenv("CONTEXT_CACHE_RETRIEVAL_K", "32"))
+CONTEXT_CACHE_PATH = os.getenv("CONTEXT_CACHE_PATH", os.path.join(tempfile.gettempdir(), "gradia-context-cache.sqlite3"))
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "10000"))
+
+# A cache this close to expiring is replaced rather than used, so it cannot expire between lookup and call
+EXPIRY_MARGIN = 60
+# What Gemini answers for cached content that expired, was deleted or belongs to another key
+MISSING_CACHE_STATUS = {400, 403, 404}
+LOCK_STRIPES = 64
+
+def prefix_key(model, prefix):
+    return hashlib.sha256(json.dumps([model, prefix]).encode("utf-8")).hexdigest()
+
+class ContextCache:
+    # Maps a prompt prefix to the name of its Gemini cached content. The map is shared by the workers on the
+    # host, so a class graded across workers uploads each prefix once; a prefix Gemini refused is remembered
+    # (with no name) until the TTL passes, so it is not uploaded again for every answer.
+    def __init__(self, store):
+        self.store = store
+        self.stats_counts = {"hits": 0, "misses": 0, "refreshed": 0, "expired": 0, "fallbacks": 0}
+        self._lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _read(self, key):
+        try:
+            return self.store.get(key)
+        except sqlite3.Error:
+            return None
+
+    def _write(self, key, value):
+        try:
+            self.store.set(key, value)
+        except sqlite3.Error:
+            pass
+
+    def _forget(self, key):
+        try:
+            self.store.delete(key)
+        except sqlite3.Error:
+            pass
+
+    def _count(self, name):
+        with self._lock:
+            self.stats_counts[name] += 1
+
+    def cacheable(self, prefix):
+        return CONTEXT_CACHE_ENABLED and estimate_tokens(prefix) >= CONTEXT_CACHE_MIN_TOKENS
+
+    def _create(self, model, key, prefix):
+        try:
+            with stage("context_cache_create"):
+                cached = get_genai_client().caches.create(model=model, config={
+                    "contents": [prefix],
+                    "ttl": f"{CONTEXT_CACHE_TTL}s",
+                    "display_name": "gradia grading prefix"
+                })
+            entry = {"name": cached.name, "expires_at": time.time() + CONTEXT_CACHE_TTL}
+        except Exception as e:
+            print(f"Context cache not created, sending full prompts: {str(e)}")
+            entry = {"name": None, "expires_at": time.time() + CONTEXT_CACHE_TTL}
+        self._write(key, entry)
+        return entry["name"]
+
+    def _refresh(self, key, entry):
+        # Caches still in use past half their TTL are extended, so a question graded all day keeps one cache
+        try:
+            get_genai_client().caches.update(name=entry["name"], config={"ttl": f"{CONTEXT_CACHE_TTL}s"})
+        except Exception:
+            return False
+        self._write(key, {"name": entry["name"], "expires_at": time.time() + CONTEXT_CACHE_TTL})
+        self._count("refreshed")
+        return True
+
+    def cache_name(self, model, prefix):
+        key = prefix_key(model, prefix)
+        # One upload per prefix even when a whole class is graded at once
+        with self._stripes[int(key[:8], 16) % LOCK_STRIPES]:
+            entry = self._read(key)
+            remaining = entry["expires_at"] - time.time() if entry is not None else 0
+            if entry is not None and entry["name"] is None:
+                return None
+            if remaining > EXPIRY_MARGIN and (remaining > CONTEXT_CACHE_TTL / 2 or self._refresh(key, entry)):
+                self._count("hits")
+                return entry["name"]
+            self._count("misses")
+            return self._create(model, key, prefix)
+
+    def generate(self, model, prefix, rest, config):
+        # Same response as generate_content(model, [prefix + rest], config); the prefix comes from cached content
+        # when it is large enough, and a cache that expired or was deleted on Gemini's side is created again once
+        if self.cacheable(prefix):
+            for _ in range(2):
+                name = self.cache_name(model, prefix)
+                if name is None:
+                    break
+                try:
+                    return generate_content(model, [rest], {**config, "cached_content": name})
+                except Exception as e:
+                    if error_status(e) not in MISSING_CACHE_STATUS:
+                        raise
+                    self._count("expired")
+                    increment("gradia_context_cache_expired_total")
+                    self._forget(prefix_key(model, prefix))
+            self._count("fallbacks")
+        return generate_content(model, [prefix + rest], config)
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": CONTEXT_CACHE_ENABLED, "min_tokens": CONTEXT_CACHE_MIN_TOKENS, **self.stats_counts}
+
+context_cache = ContextCache(SqliteCache(CONTEXT_CACHE_PATH, CONTEXT_CACHE_TTL, CONTEXT_CACHE_MAX_ENTRIES))
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# torch: PyTorch fp32; torch-int8: PyTorch with dynamically quantized Linear layers;
+# onnx / onnx-int8: ONNX Runtime (needs sentence-transformers[onnx]), fp32 or the int8 export shipped with the model
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+EMBEDDING_BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+EMBEDDING_ONNX_INT8_FILE = os.getenv("EMBEDDING_ONNX_INT8_FILE", "onnx/model_quint8_avx2.onnx")
+# Threads per worker for the model's matrix multiplications; 0 leaves the library default (one per core)
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+# A quantized backend is compared against fp32 when loaded and refused if any sample drifts below this cosine;
+# the worker then fails its embedding requests until EMBEDDING_BACKEND or EMBEDDING_PARITY_MIN is changed
+EMBEDDING_PARITY_CHECK = os.getenv("EMBEDDING_PARITY_CHECK", "true").lower() == "true"
+EMBEDDING_PARITY_MIN = float(os.getenv("EMBEDDING_PARITY_MIN", "0.98"))
+
+PARITY_TEXTS = [
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "The mitochondria produce ATP through oxidative phosphorylation.",
+    "A binary search halves the remaining interval at every step, so it runs in O(log n) time.",
+    "Newton's second law states that force equals mass times acceleration.",
+    "Supply and demand determine the equilibrium price in a competitive market.",
+    "def fibonacci(n):\n    return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)",
+    "Chapter 3: Normalisation. A relation is in third normal form when no non-key attribute depends transitively on the key.",
+    "Ohm's law: V = IR",
+]
+
+# Backend and parity outcome of the loaded model, served by /api/status
+embedding_report = {}
+
+def embedding_model_id(backend=None):
+    # Cached vectors and indexes are keyed by this, so switching backend never mixes their vectors; fp32 keeps the plain name
+    backend = backend or EMBEDDING_BACKEND
+    return EMBEDDING_MODEL_NAME if backend == "torch" else f"{EMBEDDING_MODEL_NAME}@{backend}"
+
+def set_thread_count():
+    if EMBEDDING_THREADS > 0:
+        import torch
+        torch.set_num_threads(EMBEDDING_THREADS)
+
+def onnx_model_kwargs(file_name=None):
+    kwargs = {"provider": "CPUExecutionProvider"}
+    if file_name:
+        kwargs["file_name"] = file_name
+    if EMBEDDING_THREADS > 0:
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = EMBEDDING_THREADS
+        options.inter_op_num_threads = 1
+        kwargs["session_options"] = options
+    return kwargs
+
+def load_embedder(backend):
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}', expected one of {', '.join(EMBEDDING_BACKENDS)}")
+    set_thread_count()
+    if backend == "onnx":
+        return SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu", backend="onnx", model_kwargs=onnx_model_kwargs())
+    if backend == "onnx-int8":
+        return SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu", backend="onnx", model_kwargs=onnx_model_kwargs(EMBEDDING_ONNX_INT8_FILE))
+
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    if backend == "torch-int8":
+        import torch
+        # Only the Linear layers are quantized; activations are quantized per batch at run time, so no calibration is needed
+        model = torch.ao.quantization.quantize_dynamic(model.to("cpu"), {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def embedding_parity(candidate, reference, texts=PARITY_TEXTS):
+    # Cosine similarity between the two models' vectors for the same texts
+    candidate_vectors = candidate.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+    reference_vectors = reference.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+    similarities = np.sum(candidate_vectors * reference_vectors, axis=1)
+    return {"min_cosine": round(float(similarities.min()), 4), "mean_cosine": round(float(similarities.mean()), 4)}
+
+def create_embedder():
+    model = load_embedder(EMBEDDING_BACKEND)
+    embedding_report.update({"backend": EMBEDDING_BACKEND, "model_id": embedding_model_id()})
+    if EMBEDDING_BACKEND == "torch" or not EMBEDDING_PARITY_CHECK:
+        return model
+
+    # The fp32 reference is only held for the check and released before the worker starts serving
+    parity = embedding_parity(model, load_embedder("torch"))
+    embedding_report["parity"] = parity
+    print(f"Embedding backend {EMBEDDING_BACKEND}: cosine vs fp32 min {parity['min_cosine']}, mean {parity['mean_cosine']}")
+    if parity["min_cosine"] < EMBEDDING_PARITY_MIN:
+        embedding_report["error"] = "parity check failed"
+        raise RuntimeError(
+            f"Embedding backend {EMBEDDING_BACKEND} drifted from fp32 (min cosine {parity['min_cosine']} < {EMBEDDING_PARITY_MIN}); "
+            "set EMBEDDING_BACKEND=torch or lower EMBEDDING_PARITY_MIN"
+        )
+    return model
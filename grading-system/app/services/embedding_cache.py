@@ -0,0 +1,131 @@
+import os
+import fcntl
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "20000"))
+# Optional: set to a directory to keep embeddings across restarts and share them between workers
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR")
+
+KEY_SIZE = 20
+ROW_SIZE = 8
+
+def content_key(model_name, text):
+    return hashlib.sha1(f"{model_name}\0{text}".encode("utf-8")).digest()
+
+class DiskEmbeddingStore:
+    # Append-only float32 matrix, memory-mapped for reads, plus a log of (key, row) pairs
+    def __init__(self, directory, dim):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, f"vectors-{dim}.f32")
+        self.keys_path = os.path.join(directory, f"keys-{dim}.bin")
+        self.lock_path = os.path.join(directory, f"store-{dim}.lock")
+        self._rows = {}
+        self._keys_read = 0
+        self._map = None
+
+    def _refresh_keys(self):
+        # Other workers append too, so pick up whatever was written since the last read
+        try:
+            size = os.path.getsize(self.keys_path)
+        except OSError:
+            return
+        record = KEY_SIZE + ROW_SIZE
+        size -= size % record
+        if size <= self._keys_read:
+            return
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._keys_read)
+            data = f.read(size - self._keys_read)
+        for start in range(0, len(data), record):
+            key = data[start:start + KEY_SIZE]
+            self._rows[key] = int.from_bytes(data[start + KEY_SIZE:start + record], "little")
+        self._keys_read = size
+
+    def _vectors(self, row):
+        if self._map is None or row >= self._map.shape[0]:
+            rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+            self._map = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        return self._map
+
+    def get(self, key):
+        row = self._rows.get(key)
+        if row is None:
+            self._refresh_keys()
+            row = self._rows.get(key)
+            if row is None:
+                return None
+        return np.array(self._vectors(row)[row])
+
+    def put_many(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.vectors_path, "ab") as f:
+                    first_row = f.tell() // (self.dim * 4)
+                    f.write(vectors.tobytes())
+                # Keys are written after their vectors, so a reader never sees a key without data
+                with open(self.keys_path, "ab") as f:
+                    f.write(b"".join(
+                        key + (first_row + i).to_bytes(ROW_SIZE, "little") for i, key in enumerate(keys)
+                    ))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        for i, key in enumerate(keys):
+            self._rows[key] = first_row + i
+
+class EmbeddingCache:
+    def __init__(self, dim=None, max_entries=EMBEDDING_CACHE_SIZE, directory=EMBEDDING_CACHE_DIR):
+        self.max_entries = max(1, max_entries)
+        self.directory = directory
+        self._memory = OrderedDict()
+        self._disk = None
+        if dim:
+            self._disk_store(dim)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _disk_store(self, dim):
+        if self.directory and self._disk is None:
+            self._disk = DiskEmbeddingStore(self.directory, dim)
+        return self._disk
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys):
+        results = []
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is None and self._disk is not None:
+                    vector = self._disk.get(key)
+                if vector is not None:
+                    self._remember(key, vector)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                results.append(vector)
+        return results
+
+    def put_many(self, keys, vectors):
+        if not keys:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            disk = self._disk_store(vectors.shape[1])
+            if disk is not None:
+                try:
+                    disk.put_many(keys, vectors)
+                except OSError:
+                    pass
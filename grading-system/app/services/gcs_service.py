@@ -1,35 +1,130 @@
 import os
+import hashlib
 import tempfile
-from google.cloud import storage
+import threading
+from app.services.providers import get_storage_client
+from app.utils.metrics import stage, timed, increment
 
-storage_client = storage.Client()
+# Downloads are read and uploads are sent in pieces of this size (a multiple of 256 KiB, as resumable uploads require)
+GCS_CHUNK_SIZE = max(1, int(os.getenv("GCS_CHUNK_SIZE_MB", "8"))) * 1024 * 1024
+# Course PDFs the grading path has downloaded, kept by content hash and evicted least recently used first
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "gradia-blob-cache"))
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_MB", "2048")) * 1024 * 1024
 
-def list_pdfs(bucket_name):
-    bucket = storage_client.bucket(bucket_name)
-    return [b.name for b in bucket.list_blobs() if b.name.endswith('.pdf')]
+# Only the fields the grading path and listings use, instead of every object's full metadata
+BLOB_LIST_FIELDS = "items(name,generation,md5Hash,size,updated),nextPageToken"
+PDF_GLOB = "**.pdf"
 
-def download_pdf(bucket_name, filename, local_path=None):
-    if local_path is None:
-        local_path = os.path.join(tempfile.gettempdir(), filename)
+blob_cache_lock = threading.Lock()
+
+def list_pdf_blobs(bucket_name, prefix=None):
+    bucket = get_storage_client().bucket(bucket_name)
+    with stage("gcs_list"):
+        blobs = bucket.list_blobs(prefix=prefix, match_glob=PDF_GLOB, fields=BLOB_LIST_FIELDS)
+        return [b for b in blobs if b.name.endswith('.pdf')]
+
+def list_pdfs(bucket_name, prefix=None):
+    return [b.name for b in list_pdf_blobs(bucket_name, prefix)]
+
+def list_pdfs_page(bucket_name, prefix=None, page_token=None, page_size=None):
+    # One page of names and the token for the next one (None on the last page)
+    bucket = get_storage_client().bucket(bucket_name)
+    iterator = bucket.list_blobs(
+        prefix=prefix,
+        match_glob=PDF_GLOB,
+        fields=BLOB_LIST_FIELDS,
+        page_token=page_token,
+        max_results=page_size
+    )
+    with stage("gcs_list"):
+        page = list(next(iterator.pages, []))
+    return [b.name for b in page if b.name.endswith('.pdf')], iterator.next_page_token
+
+def download_pdf(bucket_name, filename, local_path, generation=None):
     os.makedirs(os.path.dirname(local_path), exist_ok=True)
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(filename)
-    blob.download_to_filename(local_path)
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.blob(filename, chunk_size=GCS_CHUNK_SIZE, generation=generation)
+    with stage("gcs_download"):
+        blob.download_to_filename(local_path)
     return local_path
 
+def open_blob_stream(bucket_name, filename):
+    # Returns the blob's metadata and a generator of its bytes, read chunk by chunk from the same generation
+    blob = get_storage_client().bucket(bucket_name).get_blob(filename)
+    if blob is None:
+        raise FileNotFoundError(f"File '{filename}' not found in bucket '{bucket_name}'")
+
+    def chunks():
+        with blob.open("rb", chunk_size=GCS_CHUNK_SIZE) as reader:
+            while True:
+                chunk = reader.read(GCS_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    return blob, chunks()
+
+def blob_cache_path(bucket_name, blob):
+    # Content-addressed, so a re-uploaded file with the same bytes is not downloaded again
+    identity = blob.md5_hash or f"{bucket_name}/{blob.name}#{blob.generation}"
+    return os.path.join(BLOB_CACHE_DIR, hashlib.sha256(identity.encode("utf-8")).hexdigest() + ".pdf")
+
+def evict_blob_cache(keep):
+    entries = []
+    for entry in os.scandir(BLOB_CACHE_DIR):
+        if entry.name.endswith(".pdf") and entry.path != keep:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries) + os.path.getsize(keep)
+    for _, size, path in sorted(entries):
+        if total <= BLOB_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+def cached_pdf_path(bucket_name, blob):
+    path = blob_cache_path(bucket_name, blob)
+    if os.path.exists(path):
+        # mtime doubles as the last-used time for eviction
+        os.utime(path)
+        increment("gradia_cache_hits_total", cache="blob")
+        return path
+    increment("gradia_cache_misses_total", cache="blob")
+
+    os.makedirs(BLOB_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=BLOB_CACHE_DIR, suffix=".part")
+    os.close(fd)
+    try:
+        # Pinned to the listed generation so the bytes match the hash the path was named after
+        download_pdf(bucket_name, blob.name, temp_path, blob.generation)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    with blob_cache_lock:
+        evict_blob_cache(path)
+    return path
+
+@timed("gcs_upload")
 def upload_file(bucket_name, file):
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file.filename)
-    blob.upload_from_file(file)
+    # A chunk size makes the client use a resumable upload, sent piece by piece from the request stream
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.blob(file.filename, chunk_size=GCS_CHUNK_SIZE)
+    blob.upload_from_file(file.stream, content_type=file.mimetype or "application/pdf")
 
 def delete_file(bucket_name, file_name):
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(file_name)
     blob.delete()
 
 def create_bucket(bucket_name):
-    storage_client.create_bucket(bucket_name)
+    get_storage_client().create_bucket(bucket_name)
 
 def delete_bucket(bucket_name):
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     bucket.delete(force=True)
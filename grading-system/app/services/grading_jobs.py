@@ -0,0 +1,83 @@
+import base64
+import binascii
+from app.services.grading_service import grade_answer, grade_code, grade_batch, validate_batch_item, validate_batch_request
+from app.services.code_eval_service import submit_code
+from app.services.ocr_service import extract_handwritten_text
+from app.services.job_queue import JobQueue, JOBS_DB_PATH
+
+def validate_grade_answer_job(payload):
+    if not payload.get("bucket_name"):
+        return "Missing required field: bucket_name"
+    return validate_batch_item({**payload, "type": "typed"})
+
+def run_grade_answer_job(payload):
+    return grade_answer(
+        payload["question"],
+        payload["student_answer"],
+        payload["max_mark"],
+        payload["bucket_name"],
+        payload.get("rubrics"),
+        force=bool(payload.get("force")),
+        question_id=payload.get("question_id")
+    )
+
+def validate_grade_code_job(payload):
+    return validate_batch_item({**payload, "type": "coding"})
+
+def run_grade_code_job(payload):
+    return grade_code(payload["question"], payload["student_code"], payload["max_mark"], force=bool(payload.get("force")))
+
+def validate_grade_batch_job(payload):
+    return validate_batch_request(payload.get("bucket_name"), payload.get("items"), payload.get("pack"))
+
+def run_grade_batch_job(payload):
+    return {"results": grade_batch(
+        payload.get("bucket_name"),
+        payload["items"],
+        force=bool(payload.get("force")),
+        pack=payload.get("pack")
+    )}
+
+def validate_code_eval_job(payload):
+    for field in ("source_code", "language", "test_cases"):
+        if field not in payload:
+            return f"Missing {field}"
+    if not isinstance(payload["test_cases"], list):
+        return "test_cases must be a list"
+    return None
+
+def run_code_eval_job(payload):
+    return submit_code(payload["source_code"], payload["language"], payload["test_cases"])
+
+def validate_ocr_job(payload):
+    if not payload.get("image_base64"):
+        return "Missing required field: image_base64"
+    try:
+        base64.b64decode(payload["image_base64"], validate=True)
+    except (binascii.Error, TypeError, ValueError):
+        return "image_base64 must be base64-encoded image data"
+    return None
+
+def run_ocr_job(payload):
+    result = extract_handwritten_text(base64.b64decode(payload["image_base64"]))
+    if result.get("error"):
+        raise RuntimeError(result["error"])
+    return result
+
+# kind -> (validate(payload) -> error or None, run(payload) -> JSON result)
+JOB_KINDS = {
+    "grade-answer": (validate_grade_answer_job, run_grade_answer_job),
+    "grade-code": (validate_grade_code_job, run_grade_code_job),
+    "grade-batch": (validate_grade_batch_job, run_grade_batch_job),
+    "code-eval": (validate_code_eval_job, run_code_eval_job),
+    "ocr": (validate_ocr_job, run_ocr_job)
+}
+
+def validate_job(kind, payload):
+    if kind not in JOB_KINDS:
+        return f"kind must be one of: {', '.join(JOB_KINDS)}"
+    if not isinstance(payload, dict):
+        return "payload must be an object"
+    return JOB_KINDS[kind][0](payload)
+
+job_queue = JobQueue(JOBS_DB_PATH, {kind: run for kind, (_, run) in JOB_KINDS.items()})
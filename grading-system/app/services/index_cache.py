@@ -0,0 +1,153 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import faiss
+from app.services.chunking import ChunkStore
+from app.services.lexical_index import LexicalIndex
+from app.services.vector_index import configure_search
+from app.services.embedding_backend import embedding_model_id
+
+INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "gradia-index-cache"))
+INDEX_CACHE_SIZE = int(os.getenv("INDEX_CACHE_SIZE", "8"))
+
+# Bump when the stored index or chunk layout changes so old entries are rebuilt
+INDEX_FORMAT_VERSION = "5"
+SAFE_BUCKET_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,221}$")
+
+def blob_fingerprint(blobs):
+    # Any upload, overwrite or delete changes a name or generation, so the fingerprint moves with the bucket;
+    # the embedding model is part of it because an index only answers queries embedded by the model that built it
+    entries = sorted((blob.name, str(blob.generation)) for blob in blobs)
+    return hashlib.sha256(json.dumps([INDEX_FORMAT_VERSION, embedding_model_id(), entries]).encode("utf-8")).hexdigest()
+
+class IndexCache:
+    def __init__(self, cache_dir, max_entries):
+        self.cache_dir = cache_dir
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bucket_locks = {}
+
+    def _bucket_lock(self, bucket_name):
+        with self._lock:
+            return self._bucket_locks.setdefault(bucket_name, threading.Lock())
+
+    def _bucket_dir(self, bucket_name):
+        if not SAFE_BUCKET_NAME.match(bucket_name) or bucket_name.strip(".") == "":
+            bucket_name = hashlib.sha256(bucket_name.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, bucket_name)
+
+    def _get_memory(self, bucket_name, fingerprint=None):
+        # Without a fingerprint this returns whatever is cached, as the base for an incremental update
+        with self._lock:
+            entry = self._entries.get(bucket_name)
+            if entry is None or (fingerprint is not None and entry[0] != fingerprint):
+                return None
+            self._entries.move_to_end(bucket_name)
+            return entry[1:]
+
+    def _put_memory(self, bucket_name, fingerprint, index, chunks, manifest, lexical=None):
+        with self._lock:
+            self._entries[bucket_name] = (fingerprint, index, chunks, manifest, lexical)
+            self._entries.move_to_end(bucket_name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _load_disk(self, bucket_name, fingerprint=None):
+        bucket_dir = self._bucket_dir(bucket_name)
+        if fingerprint is None:
+            try:
+                names = [name for name in os.listdir(bucket_dir) if not name.startswith(".staging-")]
+            except OSError:
+                return None
+            if not names:
+                return None
+            fingerprint = names[0]
+
+        entry_dir = os.path.join(bucket_dir, fingerprint)
+        try:
+            index = configure_search(faiss.read_index(os.path.join(entry_dir, "index.faiss")))
+            chunks = ChunkStore.load(entry_dir)
+            with open(os.path.join(entry_dir, "manifest.json"), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, RuntimeError, ValueError, KeyError):
+            return None
+        try:
+            lexical = LexicalIndex.load(entry_dir)
+        except (OSError, ValueError, KeyError):
+            lexical = None
+        return index, chunks, manifest, lexical
+
+    def _save_lexical(self, bucket_name, fingerprint, lexical):
+        # Added to an entry saved without one, e.g. after switching to hybrid retrieval; readers find all files or none
+        entry_dir = os.path.join(self._bucket_dir(bucket_name), fingerprint)
+        if not os.path.isdir(entry_dir):
+            return
+        staging_dir = tempfile.mkdtemp(dir=entry_dir, prefix=".staging-")
+        try:
+            lexical.save(staging_dir)
+            for name in ("lexical.json", "lexical.npz"):
+                os.replace(os.path.join(staging_dir, name), os.path.join(entry_dir, name))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _save_disk(self, bucket_name, fingerprint, index, chunks, manifest, lexical=None):
+        bucket_dir = self._bucket_dir(bucket_name)
+        os.makedirs(bucket_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=bucket_dir, prefix=".staging-")
+        try:
+            faiss.write_index(index, os.path.join(staging_dir, "index.faiss"))
+            chunks.save(staging_dir)
+            with open(os.path.join(staging_dir, "manifest.json"), "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            if lexical is not None:
+                lexical.save(staging_dir)
+            entry_dir = os.path.join(bucket_dir, fingerprint)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(staging_dir, entry_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        for name in os.listdir(bucket_dir):
+            if name != fingerprint and not name.startswith(".staging-"):
+                shutil.rmtree(os.path.join(bucket_dir, name), ignore_errors=True)
+
+    def get_or_update(self, bucket_name, fingerprint, update, build_lexical=None):
+        # update(previous) gets the last (index, chunks, manifest) for the bucket, or None, and returns a new one.
+        # With build_lexical, an entry without a lexical index gets one built from its chunks.
+        # Entries are replaced rather than mutated, so searches already holding the old index are unaffected.
+        with self._bucket_lock(bucket_name):
+            cached = self._get_memory(bucket_name, fingerprint)
+            if cached is None:
+                cached = self._load_disk(bucket_name, fingerprint)
+                if cached is None:
+                    previous = self._get_memory(bucket_name) or self._load_disk(bucket_name)
+                    index, chunks, manifest = update(previous[:3] if previous else None)
+                    cached = (index, chunks, manifest, build_lexical(chunks) if build_lexical is not None else None)
+                    try:
+                        self._save_disk(bucket_name, fingerprint, *cached)
+                    except OSError:
+                        pass
+                self._put_memory(bucket_name, fingerprint, *cached)
+
+            if build_lexical is not None and cached[3] is None:
+                cached = (*cached[:3], build_lexical(cached[1]))
+                try:
+                    self._save_lexical(bucket_name, fingerprint, cached[3])
+                except OSError:
+                    pass
+                self._put_memory(bucket_name, fingerprint, *cached)
+            return cached[0], cached[1], cached[3]
+
+    def invalidate(self, bucket_name):
+        with self._bucket_lock(bucket_name):
+            with self._lock:
+                self._entries.pop(bucket_name, None)
+            shutil.rmtree(self._bucket_dir(bucket_name), ignore_errors=True)
+
+course_index_cache = IndexCache(INDEX_CACHE_DIR, INDEX_CACHE_SIZE)
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import hmac
+import uuid
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlparse
+import requests
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join(tempfile.gettempdir(), "gradia-jobs.sqlite3"))
+JOB_WORKERS = max(1, int(os.getenv("JOB_WORKERS", "4")))
+# A job whose lease is not renewed (its process died) goes back to the queue once the lease runs out
+JOB_LEASE_SECONDS = max(10, int(os.getenv("JOB_LEASE_SECONDS", "120")))
+JOB_MAX_ATTEMPTS = max(1, int(os.getenv("JOB_MAX_ATTEMPTS", "3")))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", str(7 * 24 * 3600)))
+# Callbacks are only sent to these hosts, e.g. the Node backend
+JOB_CALLBACK_HOSTS = {host.strip() for host in os.getenv("JOB_CALLBACK_HOSTS", "").split(",") if host.strip()}
+
+JOB_POLL_INTERVAL = 1.0
+CALLBACK_RETRIES = 3
+CALLBACK_TIMEOUT = 10
+
+def validate_callback_url(url):
+    parsed = urlparse(url) if isinstance(url, str) else None
+    if parsed is None or parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return "callback_url must be an http(s) URL"
+    if parsed.hostname not in JOB_CALLBACK_HOSTS:
+        return f"callback_url host '{parsed.hostname}' is not allowed"
+    return None
+
+def sign_callback(body):
+    key = (os.getenv("GRADIA_API_KEY") or "").encode("utf-8")
+    return hmac.new(key, body, hashlib.sha256).hexdigest()
+
+class JobQueue:
+    # Jobs live in SQLite so queued and running work survives restarts; each process runs its own worker threads
+    def __init__(self, path, handlers, workers=JOB_WORKERS, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.handlers = handlers
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._started_pid = None
+        self.worker_id = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "result TEXT, error TEXT, callback_url TEXT, callback_status TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "worker TEXT, lease_until REAL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._connect().execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def start(self):
+        # Called per request; threads do not survive a fork, so a preloaded master never owns them
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            self._running = set()
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+            threading.Thread(target=self._renew_leases, name="job-leases", daemon=True).start()
+
+    def enqueue(self, kind, payload, callback_url=None):
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO jobs (id, kind, payload, status, callback_url, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), callback_url, now, now)
+        )
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?",
+            (now - JOB_RESULT_TTL,)
+        )
+        self._wakeup.set()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "result": json.loads(row["result"]) if row["result"] is not None else None,
+            "error": row["error"],
+            "attempts": row["attempts"],
+            "callback_status": row["callback_status"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    def _claim(self):
+        now = time.time()
+        return self._connect().execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE (status = 'queued' AND (lease_until IS NULL OR lease_until <= ?)) "
+            "OR (status = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1) "
+            "RETURNING id, kind, payload, attempts, callback_url",
+            (self.worker_id, now + self.lease_seconds, now, now, now)
+        ).fetchone()
+
+    def _finish(self, job_id, status, result=None, error=None):
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = NULL, updated_at = ? WHERE id = ? AND worker = ?",
+            (status, json.dumps(result) if result is not None else None, error, time.time(), job_id, self.worker_id)
+        )
+
+    def _defer(self, job_id, delay, error):
+        # A queued job's lease_until doubles as "not before"; a deferral does not count as an attempt
+        self._connect().execute(
+            "UPDATE jobs SET status = 'queued', attempts = attempts - 1, error = ?, lease_until = ?, updated_at = ? "
+            "WHERE id = ? AND worker = ?",
+            (error, time.time() + delay, time.time(), job_id, self.worker_id)
+        )
+
+    def _renew_leases(self):
+        pid = os.getpid()
+        while self._started_pid == pid:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                running = list(self._running)
+            if running:
+                try:
+                    self._connect().executemany(
+                        "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                        [(time.time() + self.lease_seconds, job_id, self.worker_id) for job_id in running]
+                    )
+                except sqlite3.Error as e:
+                    print(f"Failed to renew job leases: {str(e)}")
+
+    def _work(self):
+        pid = os.getpid()
+        while self._started_pid == pid:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"Failed to claim a job: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            with self._lock:
+                self._running.add(job["id"])
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    self._running.discard(job["id"])
+
+    def _run(self, job):
+        if job["attempts"] > self.max_attempts:
+            # The job was picked up again after its worker died each time; stop retrying it
+            self._finish(job["id"], "failed", error=f"Job was interrupted {self.max_attempts} times")
+        else:
+            try:
+                result = self.handlers[job["kind"]](json.loads(job["payload"]))
+                self._finish(job["id"], "succeeded", result=result)
+            except Exception as e:
+                # Errors that carry retry_after (an unavailable upstream) are retried later instead of failing the job
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is not None:
+                    self._defer(job["id"], retry_after, str(e))
+                    return
+                self._finish(job["id"], "failed", error=str(e))
+
+        if job["callback_url"]:
+            self._notify(job["id"], job["callback_url"])
+
+    def _notify(self, job_id, callback_url):
+        body = json.dumps(self.get(job_id)).encode("utf-8")
+        headers = {"Content-Type": "application/json", "X-Gradia-Signature": sign_callback(body)}
+        status = "failed"
+        for attempt in range(CALLBACK_RETRIES):
+            try:
+                response = requests.post(callback_url, data=body, headers=headers, timeout=CALLBACK_TIMEOUT)
+                if response.status_code < 500:
+                    status = "sent" if response.ok else f"rejected ({response.status_code})"
+                    break
+            except requests.RequestException:
+                pass
+            time.sleep(2 ** attempt)
+        self._connect().execute("UPDATE jobs SET callback_status = ? WHERE id = ?", (status, job_id))
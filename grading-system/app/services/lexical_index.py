@@ -0,0 +1,103 @@
+import os
+import re
+import json
+import numpy as np
+from scipy import sparse
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+TERM_PATTERN = re.compile(r"[^\W_]+")
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how if in into is it its of on or such that the their then
+there these they this to was were what when where which while who why will with would you your
+""".split())
+
+def terms(text):
+    return [term for term in TERM_PATTERN.findall(text.lower()) if term not in STOPWORDS]
+
+class LexicalIndex:
+    # BM25 over a ChunkStore's rows, kept as a sparse chunk x term matrix of precomputed term weights,
+    # so scoring a batch of queries is one sparse product. ids are the chunks' vector index ids.
+    def __init__(self, vocabulary, weights, ids):
+        self.vocabulary = vocabulary
+        self.weights = weights
+        self.ids = ids
+
+    def __len__(self):
+        return self.weights.shape[0]
+
+    @classmethod
+    def build(cls, chunks):
+        vocabulary = {}
+        rows, columns = [], []
+        for row in range(len(chunks)):
+            for term in terms(chunks.embedding_text(row)):
+                rows.append(row)
+                columns.append(vocabulary.setdefault(term, len(vocabulary)))
+
+        shape = (len(chunks), len(vocabulary))
+        counts = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64))),
+            shape=shape
+        )
+        counts.sum_duplicates()
+
+        # Okapi BM25 with the non-negative idf variant; the per-chunk length normalisation is folded into the weights
+        document_frequency = np.bincount(counts.indices, minlength=shape[1])
+        idf = np.log1p((shape[0] - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+        lengths = np.asarray(counts.sum(axis=1)).ravel()
+        average_length = float(lengths.mean()) if len(lengths) else 0.0
+        norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(average_length, 1.0))
+        term_counts = counts.data
+        row_norms = np.repeat(norms, np.diff(counts.indptr)).astype(np.float32)
+        counts.data = idf[counts.indices] * term_counts * (BM25_K1 + 1) / (term_counts + row_norms)
+        return cls(vocabulary, counts, np.asarray(chunks.ids, dtype=np.int64))
+
+    def query_matrix(self, queries):
+        rows, columns = [], []
+        for row, query in enumerate(queries):
+            # Each query term counts once, so repeating a word in a question does not outweigh the rest
+            for column in {self.vocabulary[term] for term in terms(query) if term in self.vocabulary}:
+                rows.append(row)
+                columns.append(column)
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, columns)),
+            shape=(len(queries), len(self.vocabulary))
+        )
+
+    def search(self, queries, k):
+        # Same layout as a FAISS search: (len(queries), k) scores and ids, best first, padded with -1 ids
+        scores = (self.query_matrix(queries) @ self.weights.T).tocsr()
+        top_scores = np.zeros((len(queries), k), dtype=np.float32)
+        top_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for row in range(len(queries)):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            data, rows = scores.data[start:end], scores.indices[start:end]
+            if not len(data):
+                continue
+            best = np.argpartition(-data, k - 1)[:k] if len(data) > k else np.arange(len(data))
+            best = best[np.argsort(-data[best], kind="stable")]
+            top_scores[row, :len(best)] = data[best]
+            top_ids[row, :len(best)] = self.ids[rows[best]]
+        return top_scores, top_ids
+
+    def save(self, directory):
+        np.savez(
+            os.path.join(directory, "lexical.npz"),
+            data=self.weights.data,
+            indices=self.weights.indices,
+            indptr=self.weights.indptr,
+            shape=np.array(self.weights.shape, dtype=np.int64),
+            ids=self.ids
+        )
+        with open(os.path.join(directory, "lexical.json"), "w", encoding="utf-8") as f:
+            json.dump(sorted(self.vocabulary, key=self.vocabulary.get), f)
+
+    @classmethod
+    def load(cls, directory):
+        columns = np.load(os.path.join(directory, "lexical.npz"))
+        with open(os.path.join(directory, "lexical.json"), "r", encoding="utf-8") as f:
+            vocabulary = {term: column for column, term in enumerate(json.load(f))}
+        weights = sparse.csr_matrix((columns["data"], columns["indices"], columns["indptr"]), shape=tuple(columns["shape"]))
+        return cls(vocabulary, weights, columns["ids"])
@@ -0,0 +1,92 @@
+import os
+import copy
+import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import Future
+from app.utils.sqlite_cache import SqliteCache
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(tempfile.gettempdir(), "gradia-llm-cache.sqlite3"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+
+def response_cache_key(model, prompt, config=None):
+    payload = json.dumps({"model": model, "prompt": prompt, "config": config or {}}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.bypassed = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _read(self, key):
+        try:
+            return self.store.get(key)
+        except sqlite3.Error:
+            return None
+
+    def _write(self, key, value):
+        try:
+            self.store.set(key, value)
+        except sqlite3.Error:
+            pass
+
+    def get_or_compute(self, key, compute, force=False):
+        # compute() returns (value, cacheable). Identical concurrent requests share one compute call;
+        # force skips the stored answer but still refreshes it.
+        if not force and self.store is not None:
+            cached = self._read(key)
+            if cached is not None:
+                with self._lock:
+                    self.hits += 1
+                return cached
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                if force:
+                    self.bypassed += 1
+                else:
+                    self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            value, cacheable = compute()
+            if cacheable and self.store is not None:
+                self._write(key, value)
+            future.set_result(value)
+            return copy.deepcopy(value)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.store is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "bypassed": self.bypassed
+            }
+
+response_cache = ResponseCache(
+    SqliteCache(LLM_CACHE_PATH, LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES) if LLM_CACHE_ENABLED else None
+)
@@ -0,0 +1,214 @@
+import os
+import re
+import time
+import random
+import threading
+from app.services.providers import get_genai_client
+from app.utils.metrics import stage, increment
+
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "1000"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "1000000"))
+LLM_MAX_CONCURRENCY = max(1, int(os.getenv("LLM_MAX_CONCURRENCY", "8")))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# Rough budget for the JSON grade that comes back, on top of the prompt
+EXPECTED_OUTPUT_TOKENS = 300
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_DELAY_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)s$")
+
+class LLMUnavailableError(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def estimate_prompt_tokens(contents):
+    return sum(len(part) for part in contents if isinstance(part, str)) // 4
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        with self._condition:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                self._condition.wait((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount):
+        # Settles an estimate against the real usage; a negative balance delays the next callers
+        if self.rate <= 0:
+            return
+        with self._condition:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+            self._condition.notify_all()
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive transient failures; after `cooldown` one trial call is let through
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self.trial_running:
+                raise LLMUnavailableError("Gemini is unavailable; circuit breaker is open", max(remaining, 1))
+            self.trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.threshold > 0 and (self.failures >= self.threshold or self.opened_at is not None):
+                self.opened_at = time.monotonic()
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() >= self.opened_at + self.cooldown else "open"
+
+def error_status(error):
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+def is_transient(error):
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    # No HTTP status: connection resets, timeouts and other transport failures
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__module__.startswith(("httpx", "httpcore", "requests"))
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after") if hasattr(headers, "get") else None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+    # Gemini quota errors carry a google.rpc.RetryInfo detail such as {"retryDelay": "37s"}
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []) or []:
+            match = RETRY_DELAY_PATTERN.match(str(detail.get("retryDelay", ""))) if isinstance(detail, dict) else None
+            if match:
+                return float(match.group(1))
+    return None
+
+class LLMClient:
+    def __init__(self):
+        self.requests = TokenBucket(LLM_REQUESTS_PER_MINUTE)
+        self.tokens = TokenBucket(LLM_TOKENS_PER_MINUTE)
+        self.concurrency = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+        self.breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        # Token counts Gemini reported for successful calls; prompt tokens include those read from cached content
+        self.usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+
+    def _wait_for_pause(self):
+        # A rate-limit answer pauses every thread, not just the one that received it
+        while True:
+            with self._lock:
+                remaining = self._paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            if remaining > LLM_BACKOFF_MAX:
+                raise LLMUnavailableError("Gemini quota is exhausted", remaining)
+            time.sleep(remaining)
+
+    def _pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def generate(self, model, contents, config=None):
+        estimate = estimate_prompt_tokens(contents) + EXPECTED_OUTPUT_TOKENS
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            self._wait_for_pause()
+            self.breaker.before_call()
+            self.requests.acquire()
+            self.tokens.acquire(estimate)
+
+            try:
+                with self.concurrency, stage("llm"):
+                    response = get_genai_client().models.generate_content(model=model, contents=contents, config=config)
+            except Exception as e:
+                increment("gradia_llm_errors_total", status=error_status(e) or "transport")
+                if not is_transient(e):
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+
+                retry_after = retry_after_seconds(e)
+                delay = retry_after if retry_after is not None else random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+                if error_status(e) == 429:
+                    self._pause(delay)
+                if attempt >= LLM_MAX_RETRIES:
+                    raise LLMUnavailableError(f"Gemini call failed after {LLM_MAX_RETRIES} retries: {str(e)}", max(delay, 1)) from e
+                if delay > LLM_BACKOFF_MAX:
+                    # Too long to hold a worker; the caller gets the server's hint instead
+                    raise LLMUnavailableError(f"Gemini asked to retry after {delay:.0f}s", delay) from e
+                increment("gradia_llm_retries_total")
+                time.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            self._record_usage(getattr(response, "usage_metadata", None), estimate)
+            return response
+
+    def _record_usage(self, usage, estimate):
+        total_tokens = getattr(usage, "total_token_count", None)
+        if isinstance(total_tokens, int):
+            self.tokens.adjust(total_tokens - estimate)
+        with self._lock:
+            self.usage["requests"] += 1
+            self.usage["prompt_tokens"] += getattr(usage, "prompt_token_count", None) or 0
+            self.usage["cached_tokens"] += getattr(usage, "cached_content_token_count", None) or 0
+            self.usage["output_tokens"] += getattr(usage, "candidates_token_count", None) or 0
+
+    def stats(self):
+        return {
+            "breaker": self.breaker.state(),
+            "consecutive_failures": self.breaker.failures,
+            **self.usage
+        }
+
+llm_client = LLMClient()
+
+def generate_content(model, contents, config=None):
+    return llm_client.generate(model, contents, config)
@@ -0,0 +1,351 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+LOCAL_EXECUTOR_WORKERS = int(os.getenv("LOCAL_EXECUTOR_WORKERS", str(os.cpu_count() or 2)))
+LOCAL_EXECUTOR_TIME_LIMIT = float(os.getenv("LOCAL_EXECUTOR_TIME_LIMIT", "5"))
+LOCAL_EXECUTOR_MEMORY_MB = int(os.getenv("LOCAL_EXECUTOR_MEMORY_MB", "256"))
+LOCAL_EXECUTOR_OUTPUT_BYTES = int(os.getenv("LOCAL_EXECUTOR_OUTPUT_BYTES", str(64 * 1024)))
+# Counted per uid across all running submissions, threads included
+LOCAL_EXECUTOR_MAX_PROCESSES = int(os.getenv("LOCAL_EXECUTOR_MAX_PROCESSES", "512"))
+LOCAL_EXECUTOR_ISOLATE_NETWORK = os.getenv("LOCAL_EXECUTOR_ISOLATE_NETWORK", "true").lower() != "false"
+# Submissions run as this uid/gid when the service itself runs as root (65534 is "nobody")
+LOCAL_EXECUTOR_UID = os.getenv("LOCAL_EXECUTOR_UID", "65534")
+
+LOCAL_RUNTIMES = {
+    'python3': {
+        'filename': 'main.py',
+        'command': [os.getenv("LOCAL_PYTHON_BIN", sys.executable), '-I', 'main.py'],
+        'limit_address_space': True
+    },
+    'javascript': {
+        'filename': 'main.js',
+        'command': [os.getenv("LOCAL_NODE_BIN", "node"), f'--max-old-space-size={LOCAL_EXECUTOR_MEMORY_MB}', 'main.js'],
+        # V8 reserves far more virtual memory than it uses, so node is bounded by its heap flag instead
+        'limit_address_space': False
+    }
+}
+
+# Judge0 status ids, so parse_submission_result reads local results unchanged
+STATUS_ACCEPTED = (3, 'Accepted')
+STATUS_TIME_LIMIT = (5, 'Time Limit Exceeded')
+STATUS_NZEC = (11, 'Runtime Error (NZEC)')
+STATUS_OTHER = (12, 'Runtime Error (Other)')
+STATUS_INTERNAL = (13, 'Internal Error')
+SIGNAL_STATUSES = {
+    signal.SIGSEGV: (7, 'Runtime Error (SIGSEGV)'),
+    signal.SIGXFSZ: (8, 'Runtime Error (SIGXFSZ)'),
+    signal.SIGFPE: (9, 'Runtime Error (SIGFPE)'),
+    signal.SIGABRT: (10, 'Runtime Error (SIGABRT)'),
+    signal.SIGXCPU: STATUS_TIME_LIMIT
+}
+
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+
+
+def _isolate_network():
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.unshare(CLONE_NEWNET) == 0:
+        return
+    if libc.unshare(CLONE_NEWUSER | CLONE_NEWNET) == 0:
+        return
+    raise OSError(ctypes.get_errno(), "network isolation unavailable (needs CAP_SYS_ADMIN or unprivileged user namespaces)")
+
+
+def _child(request, stdin_fd, stdout_fd, stderr_fd):
+    # Runs in the forked child: lock the process down, then exec the runtime
+    import resource
+    try:
+        limits = request['limits']
+        os.chdir(request['workdir'])
+        os.dup2(stdin_fd, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        os.closerange(3, 1024)
+        os.setsid()
+
+        if limits['isolate_network']:
+            _isolate_network()
+
+        cpu = max(1, int(limits['time_limit'] + 0.999))
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (limits['output_bytes'], limits['output_bytes']))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (64, 64))
+        resource.setrlimit(resource.RLIMIT_NPROC, (limits['max_processes'], limits['max_processes']))
+        if limits['limit_address_space']:
+            memory = limits['memory_mb'] * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+        if os.getuid() == 0 and limits['uid'] is not None:
+            # Runtimes such as node reopen /dev/stdin by path, which checks the pipe's owner
+            for fd in (0, 1, 2):
+                os.fchown(fd, limits['uid'], limits['uid'])
+            os.setgroups([])
+            os.setgid(limits['uid'])
+            os.setuid(limits['uid'])
+
+        os.execvpe(request['command'][0], request['command'], {'PATH': '/usr/local/bin:/usr/bin:/bin', 'HOME': request['workdir']})
+    except BaseException as e:
+        os.write(2, f"Sandbox setup failed: {e}".encode())
+        os._exit(127)
+
+
+def _read_outputs(process_pid, stdin_data, stdin_w, stdout_r, stderr_r, output_limit, deadline):
+    import selectors
+    selector = selectors.DefaultSelector()
+    outputs = {stdout_r: bytearray(), stderr_r: bytearray()}
+    selector.register(stdout_r, selectors.EVENT_READ)
+    selector.register(stderr_r, selectors.EVENT_READ)
+
+    pending_stdin = memoryview(stdin_data)
+    if pending_stdin:
+        os.set_blocking(stdin_w, False)
+        selector.register(stdin_w, selectors.EVENT_WRITE)
+    else:
+        os.close(stdin_w)
+
+    timed_out = output_exceeded = False
+    open_streams = 2
+    while open_streams:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+
+        for key, _ in selector.select(remaining):
+            if key.fd == stdin_w:
+                try:
+                    written = os.write(stdin_w, pending_stdin[:65536])
+                    pending_stdin = pending_stdin[written:]
+                except (BrokenPipeError, BlockingIOError):
+                    pending_stdin = pending_stdin[:0]
+                if not pending_stdin:
+                    selector.unregister(stdin_w)
+                    os.close(stdin_w)
+                continue
+
+            chunk = os.read(key.fd, 65536)
+            if not chunk:
+                selector.unregister(key.fd)
+                open_streams -= 1
+                continue
+            outputs[key.fd].extend(chunk)
+            if len(outputs[key.fd]) > output_limit:
+                output_exceeded = True
+                open_streams = 0
+                break
+
+    if timed_out or output_exceeded:
+        try:
+            os.killpg(process_pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # The child may not have called setsid yet
+            try:
+                os.kill(process_pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    for key in list(selector.get_map().values()):
+        if key.fd == stdin_w:
+            os.close(stdin_w)
+    selector.close()
+    return outputs[stdout_r], outputs[stderr_r], timed_out, output_exceeded
+
+
+def _execute(request):
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+
+    started = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        os.close(stdin_w)
+        os.close(stdout_r)
+        os.close(stderr_r)
+        _child(request, stdin_r, stdout_w, stderr_w)
+
+    os.close(stdin_r)
+    os.close(stdout_w)
+    os.close(stderr_w)
+
+    limits = request['limits']
+    deadline = started + limits['time_limit'] * 2 + 1
+    stdout, stderr, timed_out, output_exceeded = _read_outputs(
+        pid, request['stdin'].encode(), stdin_w, stdout_r, stderr_r, limits['output_bytes'], deadline
+    )
+    os.close(stdout_r)
+    os.close(stderr_r)
+
+    _, wait_status, usage = os.wait4(pid, 0)
+    cpu_time = usage.ru_utime + usage.ru_stime
+
+    if timed_out or cpu_time > limits['time_limit']:
+        status = STATUS_TIME_LIMIT
+    elif output_exceeded:
+        status = STATUS_OTHER
+        stderr += b"\nOutput limit exceeded"
+    elif os.WIFSIGNALED(wait_status):
+        status = SIGNAL_STATUSES.get(os.WTERMSIG(wait_status), STATUS_OTHER)
+    elif os.WEXITSTATUS(wait_status) == 127 and stderr.startswith(b"Sandbox setup failed"):
+        status = STATUS_INTERNAL
+    elif os.WEXITSTATUS(wait_status) != 0:
+        status = STATUS_NZEC
+    else:
+        status = STATUS_ACCEPTED
+
+    limit = limits['output_bytes']
+    return {
+        'status': {'id': status[0], 'description': status[1]},
+        'stdout': stdout[:limit].decode('utf-8', 'replace'),
+        'stderr': stderr[:limit].decode('utf-8', 'replace'),
+        'compile_output': None,
+        'time': f"{cpu_time:.3f}",
+        # ru_maxrss is reported in kilobytes on Linux, the same unit Judge0 uses
+        'memory': usage.ru_maxrss
+    }
+
+
+def _serve():
+    # Worker loop: one JSON request per line on stdin, one JSON result per line on stdout
+    for line in sys.stdin:
+        request = json.loads(line)
+        workdir = tempfile.mkdtemp(prefix="gradia-run-")
+        try:
+            os.chmod(workdir, 0o755)
+            source_path = os.path.join(workdir, request['filename'])
+            with open(source_path, 'w', encoding='utf-8') as f:
+                f.write(request['source'])
+            os.chmod(source_path, 0o644)
+            request['workdir'] = workdir
+            result = _execute(request)
+        except Exception as e:
+            result = {
+                'status': {'id': STATUS_INTERNAL[0], 'description': STATUS_INTERNAL[1]},
+                'stdout': '',
+                'stderr': f"Sandbox error: {e}",
+                'compile_output': None,
+                'time': None,
+                'memory': None
+            }
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+
+class SandboxWorker:
+    def __init__(self):
+        # Started as a plain script so the worker never imports the app or its clients
+        self.process = subprocess.Popen(
+            [sys.executable, '-I', os.path.abspath(__file__)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            close_fds=True
+        )
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, request):
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("Sandbox worker exited unexpectedly")
+        return json.loads(line)
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class LocalExecutor:
+    def __init__(self, workers=LOCAL_EXECUTOR_WORKERS):
+        self.workers = max(1, workers)
+        self._idle = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+        self._dispatch = ThreadPoolExecutor(max_workers=self.workers)
+
+    def warm_up(self):
+        with self._lock:
+            while self._started < self.workers:
+                self._idle.put(SandboxWorker())
+                self._started += 1
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._started < self.workers:
+                self._started += 1
+                return SandboxWorker()
+        return self._idle.get()
+
+    def _release(self, worker):
+        if worker.alive():
+            self._idle.put(worker)
+            return
+        worker.close()
+        with self._lock:
+            self._started -= 1
+
+    def _limits(self, runtime):
+        uid = int(LOCAL_EXECUTOR_UID) if LOCAL_EXECUTOR_UID else None
+        return {
+            'time_limit': LOCAL_EXECUTOR_TIME_LIMIT,
+            'memory_mb': LOCAL_EXECUTOR_MEMORY_MB,
+            'output_bytes': LOCAL_EXECUTOR_OUTPUT_BYTES,
+            'max_processes': LOCAL_EXECUTOR_MAX_PROCESSES,
+            'isolate_network': LOCAL_EXECUTOR_ISOLATE_NETWORK,
+            'limit_address_space': runtime['limit_address_space'],
+            'uid': uid
+        }
+
+    def _run_one(self, request):
+        worker = self._acquire()
+        try:
+            return worker.run(request)
+        except Exception as e:
+            worker.close()
+            return e
+        finally:
+            self._release(worker)
+
+    def run(self, source_code, language, stdins):
+        runtime = LOCAL_RUNTIMES.get(language)
+        if runtime is None:
+            raise ValueError(f"No local runtime for language: {language}")
+
+        requests = [
+            {
+                'source': source_code,
+                'filename': runtime['filename'],
+                'command': runtime['command'],
+                'stdin': stdin,
+                'limits': self._limits(runtime)
+            }
+            for stdin in stdins
+        ]
+        return list(self._dispatch.map(self._run_one, requests))
+
+
+if __name__ == "__main__":
+    _serve()
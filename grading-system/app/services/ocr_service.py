@@ -1,14 +1,146 @@
 import io
-import json
-from google.cloud import vision_v1p3beta1 as vision
-
-def extract_handwritten_text(path):
-    client = vision.ImageAnnotatorClient()
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
-    image = vision.Image(content=content)
-    image_context = vision.ImageContext(language_hints=["en-t-i0-handwrit"])
-    response = client.document_text_detection(image=image, image_context=image_context)
-    result = {"extracted_text": response.full_text_annotation.text}
-    json_result = json.dumps(result, indent=2)
-    return json_result
+import os
+import hashlib
+import tempfile
+import threading
+from PIL import Image, ImageOps
+from app.services.providers import get_vision_client
+from app.utils.sqlite_cache import SqliteCache
+from app.utils.metrics import stage, timed, increment
+
+# Vision takes at most 16 images per batch_annotate_images call; the byte cap keeps a call under its request size limit
+OCR_BATCH_SIZE = min(16, max(1, int(os.getenv("OCR_BATCH_SIZE", "16"))))
+OCR_BATCH_MAX_BYTES = int(os.getenv("OCR_BATCH_MAX_BYTES", str(8 * 1024 * 1024)))
+# Longest side sent to Vision; handwriting stays legible well below phone-camera resolution
+OCR_MAX_DIMENSION = int(os.getenv("OCR_MAX_DIMENSION", "2048"))
+OCR_JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", "85"))
+MAX_OCR_IMAGES = 100
+
+# Regrades send the same images again; results are kept by content hash so Vision is only paid once per image
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "true").lower() == "true"
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", os.path.join(tempfile.gettempdir(), "gradia-ocr-cache.sqlite3"))
+OCR_CACHE_TTL = int(os.getenv("OCR_CACHE_TTL", str(30 * 24 * 3600)))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "20000"))
+# Bump when the shape of a cached result changes
+OCR_CACHE_VERSION = "1"
+
+HANDWRITING_HINTS = ["en-t-i0-handwrit"]
+
+def prepare_image(content):
+    # Downsized to grayscale JPEG in memory; images Pillow cannot read, or that would not get smaller, are sent as they are
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            if max(image.size) <= OCR_MAX_DIMENSION and image.format == "JPEG":
+                return content
+            image = ImageOps.exif_transpose(image).convert("L")
+            image.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION))
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return content
+
+    prepared = output.getvalue()
+    return prepared if len(prepared) < len(content) else content
+
+def ocr_cache_key(content):
+    # Preprocessing settings change what Vision sees, so they are part of the key
+    settings = f"{OCR_CACHE_VERSION}:{','.join(HANDWRITING_HINTS)}:{OCR_MAX_DIMENSION}:{OCR_JPEG_QUALITY}:"
+    return hashlib.sha256(settings.encode("utf-8") + content).hexdigest()
+
+class OcrCache:
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        result = self.store.get(key) if self.store is not None else None
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def set(self, key, result):
+        # Failed pages are retried on the next request, not remembered
+        if self.store is not None and not result.get("error"):
+            self.store.set(key, result)
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.store is not None, "hits": self.hits, "misses": self.misses}
+
+ocr_cache = OcrCache(
+    SqliteCache(OCR_CACHE_PATH, OCR_CACHE_TTL, OCR_CACHE_MAX_ENTRIES) if OCR_CACHE_ENABLED else None
+)
+
+def page_result(response):
+    if response.error.message:
+        return {"extracted_text": "", "confidence": None, "error": response.error.message}
+
+    annotation = response.full_text_annotation
+    confidences = [page.confidence for page in annotation.pages]
+    words = [
+        {"text": "".join(symbol.text for symbol in word.symbols), "confidence": round(word.confidence, 4)}
+        for page in annotation.pages
+        for block in page.blocks
+        for paragraph in block.paragraphs
+        for word in paragraph.words
+    ]
+    return {
+        "extracted_text": annotation.text,
+        "confidence": round(sum(confidences) / len(confidences), 4) if confidences else None,
+        "words": words
+    }
+
+def iter_batches(images):
+    batch, batch_bytes = [], 0
+    for image in images:
+        if batch and (len(batch) >= OCR_BATCH_SIZE or batch_bytes + len(image) > OCR_BATCH_MAX_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(image)
+        batch_bytes += len(image)
+    if batch:
+        yield batch
+
+def annotate_images(contents):
+    # One Vision round trip per batch of images; results come back in input order, one per image
+    from google.cloud import vision_v1p3beta1 as vision
+
+    client = get_vision_client()
+    image_context = vision.ImageContext(language_hints=HANDWRITING_HINTS)
+    feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+
+    results = []
+    with stage("ocr_preprocess"):
+        images = [prepare_image(content) for content in contents]
+
+    for batch in iter_batches(images):
+        increment("gradia_ocr_images_sent_total", len(batch))
+        with stage("ocr_vision"):
+            response = client.batch_annotate_images(requests=[
+                vision.AnnotateImageRequest(image=vision.Image(content=image), features=[feature], image_context=image_context)
+                for image in batch
+            ])
+        results.extend(page_result(page) for page in response.responses)
+    return results
+
+@timed("ocr")
+def extract_handwritten_texts(contents):
+    # Cached pages are answered locally and identical pages are sent once; only the rest go to Vision
+    keys = [ocr_cache_key(content) for content in contents]
+    results = {key: ocr_cache.get(key) for key in dict.fromkeys(keys)}
+
+    missing = {key: content for key, content in zip(keys, contents) if results[key] is None}
+    if missing:
+        for key, result in zip(missing, annotate_images(list(missing.values()))):
+            ocr_cache.set(key, result)
+            results[key] = result
+
+    return [dict(results[key]) for key in keys]
+
+def extract_handwritten_text(content):
+    return extract_handwritten_texts([content])[0]
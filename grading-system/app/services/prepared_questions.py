@@ -0,0 +1,75 @@
+import os
+import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from app.utils.sqlite_cache import SqliteCache
+
+# Retrieved references per test question, stored when a test is published so grading its answers skips the
+# index load, embedding and search. Kept for about a term, since answers arrive until the test closes.
+PREPARED_QUESTIONS_PATH = os.getenv("PREPARED_QUESTIONS_PATH", os.path.join(tempfile.gettempdir(), "gradia-prepared-questions.sqlite3"))
+PREPARED_QUESTIONS_TTL = int(os.getenv("PREPARED_QUESTIONS_TTL", str(120 * 24 * 3600)))
+PREPARED_QUESTIONS_MAX_ENTRIES = int(os.getenv("PREPARED_QUESTIONS_MAX_ENTRIES", "50000"))
+MAX_PREPARE_QUESTIONS = 200
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class PreparedQuestions:
+    # Entries carry the fingerprint of the bucket listing they were retrieved from (index_cache.blob_fingerprint).
+    # Callers check it against the current listing, so an upload or delete made through any host, or straight
+    # to the bucket, leaves every entry of that bucket stale and it is retrieved again on next use.
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _read(self, key):
+        try:
+            return self.store.get(key)
+        except sqlite3.Error:
+            return None
+
+    def _write(self, key, value):
+        try:
+            self.store.set(key, value)
+        except sqlite3.Error:
+            pass
+
+    def _question_key(self, bucket_name, question_id):
+        return "question:" + text_hash(json.dumps([bucket_name, str(question_id)]))
+
+    def get(self, bucket_name, question_id, question, fingerprint):
+        # None unless the question's text and the bucket's material are what they were when it was prepared
+        entry = self._read(self._question_key(bucket_name, question_id))
+        valid = (
+            entry is not None
+            and entry["question_hash"] == text_hash(question)
+            and entry.get("fingerprint") == fingerprint
+        )
+        with self._lock:
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry if valid else None
+
+    def put(self, bucket_name, question_id, question, fingerprint, references, prompt_head=None, prompt_inputs=None):
+        # fingerprint is taken from the listing made before retrieving, so material changed meanwhile leaves the entry stale
+        self._write(self._question_key(bucket_name, question_id), {
+            "question_hash": text_hash(question),
+            "fingerprint": fingerprint,
+            "references": references,
+            "prompt_head": prompt_head,
+            "prompt_inputs": prompt_inputs
+        })
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+prepared_questions = PreparedQuestions(
+    SqliteCache(PREPARED_QUESTIONS_PATH, PREPARED_QUESTIONS_TTL, PREPARED_QUESTIONS_MAX_ENTRIES)
+)
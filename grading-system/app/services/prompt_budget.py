@@ -0,0 +1,67 @@
+import os
+from app.services.chunking import estimate_tokens
+
+# Estimated tokens for a whole grading prompt; reference material gets what the rest of the prompt leaves
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+# References still get this much when a long answer or rubric uses up the budget by itself
+MIN_REFERENCE_TOKENS = int(os.getenv("MIN_REFERENCE_TOKENS", "400"))
+# Retrieved chunks less similar to the question than this (cosine) are not sent; the best one always is
+REFERENCE_MIN_SIMILARITY = float(os.getenv("REFERENCE_MIN_SIMILARITY", "0.25"))
+
+# Shorter word runs shared by two chunks are coincidence, not the chunker's overlap
+MIN_OVERLAP_WORDS = 4
+
+def shared_run(first, second):
+    # Length of the longest run of words that ends `first` and starts `second`
+    for size in range(min(len(first), len(second)), MIN_OVERLAP_WORDS - 1, -1):
+        if first[-size:] == second[:size]:
+            return size
+    return 0
+
+def trim_overlap(text, other):
+    # Neighbouring chunks repeat a few sentences of each other; only the new words are kept
+    words, other_words = text.split(), other.split()
+    if f" {' '.join(words)} " in f" {' '.join(other_words)} ":
+        return ""
+    words = words[shared_run(other_words, words):]
+    return " ".join(words[:len(words) - shared_run(words, other_words)])
+
+def reference_budget(prompt_without_references):
+    return max(MIN_REFERENCE_TOKENS, PROMPT_TOKEN_BUDGET - estimate_tokens(prompt_without_references))
+
+def select_references(chunks, budget, min_similarity=REFERENCE_MIN_SIMILARITY):
+    # Best first (by fused rank in hybrid retrieval, else by similarity); weak matches, repeated text
+    # and whatever does not fit the budget are left out
+    ranked = sorted(chunks, key=lambda chunk: chunk.get("rrf", chunk.get("score", 1.0)), reverse=True)
+    selected = []
+    used = 0
+
+    for position, chunk in enumerate(ranked):
+        if position > 0 and chunk.get("score", 1.0) < min_similarity:
+            continue
+
+        text = chunk["text"]
+        for other in selected:
+            if other["source"] == chunk["source"] and other["page"] == chunk["page"]:
+                text = trim_overlap(text, other["text"])
+        if not text:
+            continue
+
+        tokens = estimate_tokens(text)
+        if used + tokens > budget:
+            continue
+        selected.append({**chunk, "text": text})
+        used += tokens
+
+    return selected
+
+def format_reference_material(chunks, first_id=1):
+    # Compact source labels with ids the grader can cite, e.g. "[S1] notes.pdf p.3 § Deadlocks"
+    if not chunks:
+        return "No relevant reference material was found."
+
+    def label(position, chunk):
+        heading = f" § {chunk['heading']}" if chunk.get("heading") else ""
+        return f"[S{position}] {chunk['source']} p.{chunk['page']}{heading}"
+
+    return "\n\n".join(f"{label(position, chunk)}\n{chunk['text']}" for position, chunk in enumerate(chunks, first_id))
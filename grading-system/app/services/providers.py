@@ -0,0 +1,83 @@
+import os
+import time
+import threading
+from app.services.embedding_backend import create_embedder, embedding_report
+
+# Load the embedding model in the gunicorn master (with --preload) so forked workers share its pages
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "false").lower() == "true"
+
+# Seconds each provider took to create, in the order they were first used
+startup_timings = {}
+
+class LazyProvider:
+    # Creates its object on first use; one instance per process, shared by every thread.
+    # With remember_failure, a factory that raised is not run again: later calls re-raise its error,
+    # for failures that would only repeat (and take as long) on every request.
+    def __init__(self, name, factory, remember_failure=False):
+        self.name = name
+        self.factory = factory
+        self.remember_failure = remember_failure
+        self._instance = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._error is not None:
+                    raise self._error
+                if self._instance is None:
+                    started = time.perf_counter()
+                    try:
+                        self._instance = self.factory()
+                    except Exception as e:
+                        if self.remember_failure:
+                            self._error = e
+                        raise
+                    startup_timings[self.name] = round(time.perf_counter() - started, 3)
+        return self._instance
+
+    def loaded(self):
+        return self._instance is not None
+
+def _create_genai_client():
+    from google import genai
+    return genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+
+def _create_storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+def _create_vision_client():
+    from google.cloud import vision_v1p3beta1 as vision
+    return vision.ImageAnnotatorClient()
+
+# Loading the model takes seconds and a refused backend (see EMBEDDING_PARITY_MIN) stays refused
+embedder = LazyProvider("embedder", create_embedder, remember_failure=True)
+genai_client = LazyProvider("genai", _create_genai_client)
+storage_client = LazyProvider("storage", _create_storage_client)
+vision_client = LazyProvider("vision", _create_vision_client)
+
+def get_embedder():
+    return embedder.get()
+
+def get_genai_client():
+    return genai_client.get()
+
+def get_storage_client():
+    return storage_client.get()
+
+def get_vision_client():
+    return vision_client.get()
+
+def preload_models():
+    # Only the model is preloaded: network clients hold sockets and threads that must not cross a fork
+    if PRELOAD_MODELS:
+        get_embedder()
+
+def provider_status():
+    return {
+        "loaded": [provider.name for provider in (embedder, genai_client, storage_client, vision_client) if provider.loaded()],
+        "timings": dict(startup_timings),
+        "embedding": dict(embedding_report)
+    }
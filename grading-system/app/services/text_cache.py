@@ -0,0 +1,64 @@
+import os
+import json
+import hashlib
+import tempfile
+
+TEXT_CACHE_DIR = os.getenv("TEXT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "gradia-text-cache"))
+# Bump when extraction output changes so stale page text is not reused
+EXTRACTOR_VERSION = "1"
+
+def text_cache_key(bucket_name, blob):
+    # md5 identifies the bytes wherever they live; generation is the fallback for composite objects
+    if getattr(blob, "md5_hash", None):
+        identity = f"md5:{blob.md5_hash}"
+    else:
+        identity = f"gen:{bucket_name}/{blob.name}#{blob.generation}"
+    return hashlib.sha256(f"{EXTRACTOR_VERSION}|{identity}".encode("utf-8")).hexdigest()
+
+def _cache_path(key):
+    return os.path.join(TEXT_CACHE_DIR, key[:2], f"{key}.jsonl")
+
+def iter_cached_pages(key):
+    path = _cache_path(key)
+    if not os.path.exists(path):
+        return None
+
+    def pages():
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                yield record["page"], record["text"]
+
+    return pages()
+
+class PageCacheWriter:
+    def __init__(self, key):
+        self.path = _cache_path(key)
+        self._file = None
+
+    def __enter__(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, self._temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".partial")
+            self._file = os.fdopen(fd, "w", encoding="utf-8")
+        except OSError:
+            self._file = None
+        return self
+
+    def write(self, page_number, text):
+        if self._file is not None:
+            self._file.write(json.dumps({"page": page_number, "text": text}) + "\n")
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._file is None:
+            return False
+        self._file.close()
+        # Only a fully extracted document is published; partial reads are thrown away
+        if exc_type is None:
+            os.replace(self._temp_path, self.path)
+        else:
+            try:
+                os.remove(self._temp_path)
+            except OSError:
+                pass
+        return False
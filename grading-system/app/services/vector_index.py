@@ -0,0 +1,183 @@
+import os
+import math
+import tempfile
+import numpy as np
+import faiss
+
+# auto picks by corpus size; flat, hnsw, ivf or ivfpq forces a type
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")
+INDEX_FLAT_MAX = int(os.getenv("INDEX_FLAT_MAX", "20000"))
+INDEX_HNSW_MAX = int(os.getenv("INDEX_HNSW_MAX", "200000"))
+INDEX_IVF_MAX = int(os.getenv("INDEX_IVF_MAX", "1000000"))
+INDEX_HNSW_M = int(os.getenv("INDEX_HNSW_M", "32"))
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", "16"))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+# PQ codes alone lose too much recall; candidates are re-ranked against 8-bit scalar-quantized vectors
+INDEX_PQ_REFINE = os.getenv("INDEX_PQ_REFINE", "SQ8")
+INDEX_REFINE_K_FACTOR = float(os.getenv("INDEX_REFINE_K_FACTOR", "4"))
+INDEX_TRAIN_SAMPLE = int(os.getenv("INDEX_TRAIN_SAMPLE", "100000"))
+INDEX_RECALL_QUERIES = int(os.getenv("INDEX_RECALL_QUERIES", "200"))
+INDEX_RECALL_K = 5
+
+ADD_BATCH_SIZE = 65536
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+
+class EmbeddingSpool:
+    # Embeddings are spilled to disk while chunks stream in, since the index type depends on the final count
+    def __init__(self, dim):
+        self.dim = dim
+        self.count = 0
+        self._file = tempfile.TemporaryFile(prefix="gradia-embeddings-")
+
+    def append(self, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self._file.write(embeddings.tobytes())
+        self.count += embeddings.shape[0]
+
+    def vectors(self):
+        self._file.flush()
+        if self.count == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self._file, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+
+    def close(self):
+        self._file.close()
+
+def choose_index_type(count):
+    if INDEX_TYPE in INDEX_TYPES:
+        index_type = INDEX_TYPE
+    elif count <= INDEX_FLAT_MAX:
+        index_type = "flat"
+    elif count <= INDEX_HNSW_MAX:
+        index_type = "hnsw"
+    elif count <= INDEX_IVF_MAX:
+        index_type = "ivf"
+    else:
+        index_type = "ivfpq"
+
+    # Forced types still need enough points to train PQ codebooks (256 centroids) and lists
+    if index_type == "ivfpq" and count < 39 * 256:
+        index_type = "ivf"
+    if index_type == "ivf" and count < 44 * 2:
+        index_type = "flat"
+    return index_type
+
+def ivf_list_count(count):
+    # Roughly 4 * sqrt(n) lists, leaving 39 training points per list after the recall queries are held out
+    return max(1, min(int(4 * math.sqrt(count)), count // 44))
+
+def pq_subquantizers(dim):
+    for m in (48, 32, 24, 16, 12, 8, 6, 4, 3, 2, 1):
+        if dim % m == 0:
+            return m
+    return 1
+
+def create_index(index_type, dim, count):
+    metric = faiss.METRIC_INNER_PRODUCT
+    if index_type == "hnsw":
+        return faiss.index_factory(dim, f"HNSW{INDEX_HNSW_M},Flat", metric)
+    if index_type == "ivf":
+        return faiss.index_factory(dim, f"IVF{ivf_list_count(count)},Flat", metric)
+    if index_type == "ivfpq":
+        refine = f",Refine({INDEX_PQ_REFINE})" if INDEX_PQ_REFINE else ""
+        return faiss.index_factory(dim, f"IVF{ivf_list_count(count)},PQ{pq_subquantizers(dim)}{refine}", metric)
+    return faiss.IndexFlatIP(dim)
+
+def configure_search(index):
+    # Search knobs come from the environment, so indexes loaded from disk pick up the current values
+    if isinstance(index, faiss.IndexIDMap):
+        configure_search(faiss.downcast_index(index.index))
+        return index
+    if isinstance(index, faiss.IndexRefine):
+        index.k_factor = INDEX_REFINE_K_FACTOR
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(INDEX_NPROBE, ivf.nlist)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = INDEX_EF_SEARCH
+    return index
+
+def sample_rows(count, size, seed=0):
+    if size >= count:
+        return np.arange(count)
+    return np.sort(np.random.default_rng(seed).choice(count, size, replace=False))
+
+def add_vectors(index, vectors, ids):
+    for start in range(0, len(ids), ADD_BATCH_SIZE):
+        index.add_with_ids(
+            np.ascontiguousarray(vectors[start:start + ADD_BATCH_SIZE]),
+            ids[start:start + ADD_BATCH_SIZE]
+        )
+
+def index_type_of(index):
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, (faiss.IndexRefine, faiss.IndexIVFPQ)):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+def without_self(rows, query_ids, k):
+    # Each query is a stored vector and finds itself at distance 0; only its other neighbours are scored
+    return [row[(row >= 0) & (row != query_id)][:k] for row, query_id in zip(rows, query_ids)]
+
+def measure_recall(index, vectors, query_rows, ids, k=INDEX_RECALL_K):
+    # Exact top-k from a flat scan over the same vectors is the ground truth
+    count = vectors.shape[0]
+    if count < 2 or len(query_rows) == 0:
+        return None
+    queries = np.ascontiguousarray(vectors[query_rows])
+    k = min(k, count - 1)
+    search_k = k + 1
+
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    best_scores = np.full((len(queries), search_k), -np.inf, dtype=np.float32)
+    best_ids = np.full((len(queries), search_k), -1, dtype=np.int64)
+    for start in range(0, count, ADD_BATCH_SIZE):
+        exact.reset()
+        exact.add(np.ascontiguousarray(vectors[start:start + ADD_BATCH_SIZE]))
+        scores, rows = exact.search(queries, search_k)
+        rows = np.where(rows >= 0, rows + start, -1)
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_ids = np.concatenate([best_ids, rows], axis=1)
+        order = np.argsort(-merged_scores, axis=1)[:, :search_k]
+        best_scores = np.take_along_axis(merged_scores, order, axis=1)
+        best_ids = np.take_along_axis(merged_ids, order, axis=1)
+
+    query_ids = ids[query_rows]
+    truths = without_self(np.where(best_ids >= 0, ids[np.maximum(best_ids, 0)], -1), query_ids, k)
+    _, found = index.search(queries, search_k)
+    found = without_self(found, query_ids, k)
+    hits = sum(len(set(truth) & set(row)) for truth, row in zip(truths, found))
+    return hits / max(1, sum(len(truth) for truth in truths))
+
+def build_index(spool, first_id=0):
+    # Vectors are stored under chunk ids, so single files can later be removed with remove_ids
+    vectors = spool.vectors()
+    count, dim = vectors.shape
+    index_type = choose_index_type(count)
+    report = {"type": index_type, "vectors": count}
+
+    # Recall queries are held out of training so the report is not measured on the training set
+    query_rows = np.zeros(0, dtype=np.int64)
+    if index_type != "flat":
+        query_rows = sample_rows(count, min(INDEX_RECALL_QUERIES, count // 10), seed=1)
+
+    index = create_index(index_type, dim, count)
+    if not index.is_trained:
+        pool = np.setdiff1d(np.arange(count), query_rows)
+        train_rows = pool[sample_rows(len(pool), min(len(pool), INDEX_TRAIN_SAMPLE))]
+        index.train(np.ascontiguousarray(vectors[train_rows]))
+        report["trained_on"] = len(train_rows)
+    index = configure_search(faiss.IndexIDMap(index))
+
+    ids = np.arange(first_id, first_id + count, dtype=np.int64)
+    add_vectors(index, vectors, ids)
+
+    if index_type != "flat":
+        report["recall_at_k"] = measure_recall(index, vectors, query_rows, ids)
+        report["k"] = INDEX_RECALL_K
+    return index, report
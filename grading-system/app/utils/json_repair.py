@@ -0,0 +1,58 @@
+import re
+import json
+
+TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"'})
+
+def object_candidates(text):
+    # The first balanced {...}, skipping brackets inside strings. Output cut off mid-object is closed at the end,
+    # and also cut back to its last complete element, e.g. the last whole entry of a truncated list.
+    start = text.find("{")
+    if start < 0:
+        return []
+
+    closers = []
+    in_string = False
+    escaped = False
+    last_complete = None
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]" and closers:
+            closers.pop()
+            if not closers:
+                return [text[start:i + 1]]
+            last_complete = (i + 1, "".join(reversed(closers)))
+
+    candidates = [text[start:].rstrip().rstrip(",") + ('"' if in_string else "") + "".join(reversed(closers))]
+    if last_complete is not None:
+        end, closing = last_complete
+        candidates.append(text[start:end] + closing)
+    return candidates
+
+def parse_json_object(text):
+    # Strict parsing first; the repairs only run on text that fails it, so valid JSON is never rewritten
+    if not isinstance(text, str):
+        return None
+
+    for source in (text, text.translate(SMART_QUOTES)):
+        for candidate in object_candidates(source):
+            for repaired in (candidate, TRAILING_COMMA.sub(r"\1", candidate)):
+                try:
+                    value = json.loads(repaired, strict=False)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(value, dict):
+                    return value
+
+    return None
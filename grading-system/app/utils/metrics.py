@@ -0,0 +1,113 @@
+import os
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Adds a Server-Timing header with the stages each request went through
+SERVER_TIMING_HEADERS = os.getenv("SERVER_TIMING_HEADERS", "false").lower() == "true"
+
+# Seconds; stages range from cache lookups to index builds over a whole course
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_request_timings = ContextVar("request_timings", default=None)
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+class Metrics:
+    # In-process counters and histograms, rendered in the Prometheus text format; each worker process has its own
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0}
+            position = bisect.bisect_left(DURATION_BUCKETS, seconds)
+            if position < len(DURATION_BUCKETS):
+                histogram["buckets"][position] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def render(self, samples=()):
+        # samples: extra (name, type, labels, value) read from elsewhere at scrape time, e.g. cache statistics
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: {**value, "buckets": list(value["buckets"])} for key, value in self.histograms.items()}
+
+        families = {}
+        for (name, labels), value in sorted(counters.items()):
+            families.setdefault((name, "counter"), []).append(f"{name}{format_labels(labels)} {value}")
+        for name, kind, labels, value in samples:
+            families.setdefault((name, kind), []).append(f"{name}{format_labels(label_key(labels))} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            lines = families.setdefault((name, "histogram"), [])
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+
+        output = []
+        for (name, kind), lines in sorted(families.items()):
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+metrics = Metrics()
+
+def increment(name, amount=1, **labels):
+    metrics.increment(name, amount, **labels)
+
+@contextmanager
+def stage(name):
+    # Times a pipeline stage into gradia_stage_seconds and, inside a request, its Server-Timing entry
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("gradia_stage_seconds", elapsed, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start_request_timing():
+    _request_timings.set([])
+
+def server_timing_header():
+    # Stages that ran on pool threads do not carry the request's context and are only in /api/metrics
+    totals = {}
+    for name, elapsed in _request_timings.get() or []:
+        totals[name] = totals.get(name, 0.0) + elapsed
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in totals.items())
@@ -0,0 +1,71 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+class SqliteCache:
+    # JSON key-value store shared by every worker process on the host; entries expire after ttl seconds
+    # and the least recently used ones are evicted once there are more than max_entries.
+    def __init__(self, path, ttl, max_entries, prune_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.prune_every = max(1, prune_every)
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + self.ttl, now)
+        )
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.prune_every == 0
+        if prune:
+            self.prune()
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def prune(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM entries WHERE key IN ("
+            "SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
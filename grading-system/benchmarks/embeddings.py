@@ -0,0 +1,92 @@
+# Compares the embedding backends on throughput, memory and agreement with fp32:
+#
+#   python -m benchmarks.embeddings --backends torch,torch-int8,onnx-int8 --texts 2000 --threads 1
+#
+# Each backend is loaded in its own process, so the RSS it reports is what one grading worker would hold.
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from benchmarks.run import TOPICS
+
+def sample_texts(count):
+    # Chunk-like texts of mixed length, the way course PDFs split into headings, short paragraphs and long ones
+    rng = np.random.default_rng(0)
+    words = " ".join(paragraph for _, paragraph in TOPICS).split()
+    return [" ".join(rng.choice(words, size=int(rng.integers(8, 220)))) for _ in range(count)]
+
+def rss_mb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def measure(backend, threads, texts, results):
+    os.environ["EMBEDDING_BACKEND"] = backend
+    os.environ["EMBEDDING_PARITY_CHECK"] = "false"
+    os.environ["EMBEDDING_CACHE_DIR"] = ""
+    if threads:
+        os.environ["EMBEDDING_THREADS"] = str(threads)
+    from app.services.embedding_backend import load_embedder
+    from app.services import grading_service
+
+    before = rss_mb()
+    started = time.perf_counter()
+    model = load_embedder(backend)
+    load_seconds = time.perf_counter() - started
+    model_mb = rss_mb() - before
+
+    grading_service.get_embedder = lambda: model
+    grading_service.get_embedding_cache().max_entries = 1
+    grading_service.embed_texts(texts[:32])
+    started = time.perf_counter()
+    vectors = grading_service.embed_texts(texts[32:])
+    elapsed = time.perf_counter() - started
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    results.put((backend, {
+        "load_seconds": round(load_seconds, 2),
+        "model_mb": round(model_mb, 1),
+        "texts_per_second": round((len(texts) - 32) / elapsed, 1),
+        "vectors": vectors / np.where(norms == 0, 1, norms)
+    }))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput, memory and fp32 parity of the embedding backends")
+    parser.add_argument("--backends", default="torch,torch-int8")
+    parser.add_argument("--texts", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=1, help="threads per backend, to compare throughput per core")
+    args = parser.parse_args(argv)
+
+    backends = [backend.strip() for backend in args.backends.split(",") if backend.strip()]
+    if "torch" not in backends:
+        backends.insert(0, "torch")
+    texts = sample_texts(args.texts + 32)
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    measured = {}
+    for backend in backends:
+        process = context.Process(target=measure, args=(backend, args.threads, texts, results))
+        process.start()
+        try:
+            name, result = results.get(timeout=1800)
+            measured[name] = result
+        except Exception:
+            print(f"{backend}: failed to load or run", file=sys.stderr)
+        process.join()
+
+    reference = measured.get("torch", {}).get("vectors")
+    print(f"\n{'backend':<12}{'load s':>8}{'model MB':>10}{'texts/s':>10}{'min cos':>9}{'mean cos':>10}")
+    for backend, result in measured.items():
+        similarities = np.sum(result["vectors"] * reference, axis=1) if reference is not None else np.array([np.nan])
+        print(f"{backend:<12}{result['load_seconds']:>8}{result['model_mb']:>10}{result['texts_per_second']:>10}"
+              f"{similarities.min():>9.4f}{similarities.mean():>10.4f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import os
+import re
+import io
+import time
+import json
+import base64
+import hashlib
+import threading
+import uuid
+import numpy as np
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+# Local stand-ins for every external service the grading service calls, each with an injected latency
+# so throughput and tail latency can be measured without credentials, network or quota
+
+class Latency:
+    # Seconds a fake waits per call; jitter is a fraction of the base, spread uniformly either side
+    def __init__(self, seconds, jitter=0.2, seed=0):
+        self.seconds = seconds
+        self.jitter = jitter
+        self._random = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def wait(self, scale=1.0):
+        if self.seconds <= 0:
+            return
+        with self._lock:
+            factor = 1 + self.jitter * (2 * self._random.random() - 1)
+        time.sleep(self.seconds * scale * factor)
+
+
+class HashingEmbedder:
+    # Bag-of-words hashed into a fixed vector; deterministic and fast, so the vector path runs without the model download
+    dimension = 384
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, convert_to_numpy=True, **kwargs):
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        vectors = np.zeros((len(texts), self.dimension), dtype="float32")
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                vectors[row, int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % self.dimension] += 1.0
+        if kwargs.get("normalize_embeddings"):
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        return vectors[0] if single else vectors
+
+
+class FakeClientError(Exception):
+    # Carries an HTTP status in .code, like google.genai.errors.ClientError
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeUsage:
+    def __init__(self, prompt_tokens, output_tokens, cached_tokens=0):
+        self.prompt_token_count = prompt_tokens
+        self.cached_content_token_count = cached_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeGenerateResponse:
+    def __init__(self, text, parsed, prompt_tokens, cached_tokens=0):
+        self.text = text
+        self.parsed = parsed
+        output_tokens = max(1, len(text) // 4)
+        self.usage_metadata = FakeUsage(prompt_tokens, output_tokens, cached_tokens)
+
+
+class FakeCachedContent:
+    def __init__(self, name, model, text, expire_time):
+        self.name = name
+        self.model = model
+        self.text = text
+        self.expire_time = expire_time
+
+
+class FakeCaches:
+    # Gemini's cached-content API: entries expire after their TTL and are refused below min_tokens
+    def __init__(self, min_tokens=4096):
+        self.min_tokens = min_tokens
+        self.entries = {}
+        self.stats = {"created": 0, "updated": 0, "deleted": 0}
+        self._lock = threading.Lock()
+
+    def _ttl(self, config):
+        return float(str(config.get("ttl", "3600s")).rstrip("s"))
+
+    def create(self, model, config):
+        text = "\n".join(part for part in config.get("contents", []) if isinstance(part, str))
+        if len(text) // 4 < self.min_tokens:
+            raise FakeClientError(400, f"Cached content is too small: min_total_token_count is {self.min_tokens}")
+        entry = FakeCachedContent(f"cachedContents/{uuid.uuid4().hex}", model, text, time.time() + self._ttl(config))
+        with self._lock:
+            self.entries[entry.name] = entry
+            self.stats["created"] += 1
+        return entry
+
+    def get(self, name):
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None or entry.expire_time <= time.time():
+                self.entries.pop(name, None)
+                raise FakeClientError(404, f"CachedContent not found: {name}")
+            return entry
+
+    def update(self, name, config):
+        entry = self.get(name)
+        with self._lock:
+            entry.expire_time = time.time() + self._ttl(config)
+            self.stats["updated"] += 1
+        return entry
+
+    def delete(self, name):
+        with self._lock:
+            self.entries.pop(name, None)
+            self.stats["deleted"] += 1
+
+
+class FakeModels:
+    # Answers with a grade in the requested schema; the latency grows with the prompt like a real model's prefill,
+    # of which tokens read from cached content pay a tenth
+    def __init__(self, latency, seconds_per_1k_tokens, caches):
+        self.latency = latency
+        self.seconds_per_1k_tokens = seconds_per_1k_tokens
+        self.caches = caches
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def grade_for(self, contents):
+        max_marks = [float(mark) for mark in re.findall(r"MAX MARK\s*=\s*([\d.]+)", contents, re.IGNORECASE)]
+        return min(max_marks[0] if max_marks else 1, 3)
+
+    def generate_content(self, model, contents, config=None):
+        with self._lock:
+            self.calls += 1
+        prompt = "\n".join(part for part in contents if isinstance(part, str)) if isinstance(contents, list) else contents
+        cached_name = config.get("cached_content") if isinstance(config, dict) else None
+        cached_text = self.caches.get(cached_name).text if cached_name else ""
+        cached_tokens = len(cached_text) // 4
+        prompt_tokens = max(1, len(prompt) // 4)
+        self.latency.wait()
+        time.sleep(self.seconds_per_1k_tokens * (prompt_tokens + cached_tokens / 10) / 1000)
+        prompt = cached_text + prompt
+
+        schema = config.get("response_schema") if isinstance(config, dict) else None
+        grade = self.grade_for(prompt)
+        if schema is not None and "grades" in schema.model_fields:
+            numbers = [int(number) for number in re.findall(r"^\s*\[A(\d+)\]", prompt, re.MULTILINE)]
+            payload = {"grades": [
+                {"answer": number, "grade": grade, "feedback": "Covers the main points.", "reference": "S1"}
+                for number in numbers
+            ]}
+        else:
+            payload = {"grade": grade, "feedback": "Covers the main points.", "reference": "S1"}
+        text = json.dumps(payload)
+        parsed = schema.model_validate(payload) if schema is not None else None
+        return FakeGenerateResponse(text, parsed, prompt_tokens + cached_tokens, cached_tokens)
+
+
+class FakeGenaiClient:
+    def __init__(self, latency, seconds_per_1k_tokens=0.0, cache_min_tokens=4096):
+        self.caches = FakeCaches(cache_min_tokens)
+        self.models = FakeModels(latency, seconds_per_1k_tokens, self.caches)
+
+
+class FakeBlob:
+    # A file under the fake bucket's directory; generation and md5 come from the file the way GCS derives them from the object
+    def __init__(self, bucket, name, generation=None, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def generation(self):
+        return os.stat(self.path).st_mtime_ns
+
+    @property
+    def md5_hash(self):
+        with open(self.path, "rb") as file:
+            return base64.b64encode(hashlib.md5(file.read()).digest()).decode("ascii")
+
+    @property
+    def size(self):
+        return os.stat(self.path).st_size
+
+    @property
+    def content_type(self):
+        return "application/pdf" if self.name.endswith(".pdf") else "application/octet-stream"
+
+    @property
+    def updated(self):
+        return None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def reload(self):
+        pass
+
+    def download_to_filename(self, local_path):
+        self.bucket.client.download_latency.wait(scale=max(1.0, self.size / (1024 * 1024)))
+        with open(self.path, "rb") as source, open(local_path, "wb") as target:
+            target.write(source.read())
+
+    def open(self, mode="rb", **kwargs):
+        self.bucket.client.download_latency.wait()
+        return open(self.path, mode)
+
+    def upload_from_file(self, stream, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as target:
+            target.write(stream.read())
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class FakeBlobPages:
+    def __init__(self, blobs, page_token, max_results):
+        start = int(page_token or 0)
+        end = start + max_results if max_results else len(blobs)
+        self._page = blobs[start:end]
+        self.next_page_token = str(end) if end < len(blobs) else None
+        self.pages = iter([self._page])
+
+    def __iter__(self):
+        return iter(self._page)
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.root = os.path.join(client.root, name)
+
+    def blob(self, name, **kwargs):
+        return FakeBlob(self, name, kwargs.get("generation"), kwargs.get("chunk_size"))
+
+    def get_blob(self, name):
+        blob = FakeBlob(self, name)
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix=None, page_token=None, max_results=None, **kwargs):
+        self.client.list_latency.wait()
+        names = []
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                name = os.path.relpath(os.path.join(directory, file), self.root).replace(os.sep, "/")
+                if not prefix or name.startswith(prefix):
+                    names.append(name)
+        return FakeBlobPages([FakeBlob(self, name) for name in sorted(names)], page_token, max_results)
+
+    def delete(self, force=False):
+        for directory, _, files in os.walk(self.root, topdown=False):
+            for file in files:
+                os.remove(os.path.join(directory, file))
+            os.rmdir(directory)
+
+
+class FakeStorageClient:
+    # Buckets are directories under root, so a local folder of course PDFs can stand in for a course bucket
+    def __init__(self, root, list_latency, download_latency):
+        self.root = root
+        self.list_latency = list_latency
+        self.download_latency = download_latency
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def create_bucket(self, name):
+        os.makedirs(os.path.join(self.root, name))
+
+
+class FakeVisionClient:
+    # Returns a fixed handwriting transcription per image, one Vision round trip per batch call
+    def __init__(self, latency, seconds_per_image=0.0):
+        self.latency = latency
+        self.seconds_per_image = seconds_per_image
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def batch_annotate_images(self, requests):
+        from google.cloud import vision_v1p3beta1 as vision
+
+        with self._lock:
+            self.calls += 1
+        self.latency.wait()
+        time.sleep(self.seconds_per_image * len(requests))
+
+        responses = []
+        for annotate_request in requests:
+            digest = hashlib.sha256(annotate_request.image.content).hexdigest()[:8]
+            words = ["Photosynthesis", "converts", "light", "energy", digest]
+            responses.append(vision.AnnotateImageResponse(full_text_annotation={
+                "text": " ".join(words) + "\n",
+                "pages": [{
+                    "confidence": 0.93,
+                    "blocks": [{"paragraphs": [{"words": [
+                        {"confidence": 0.93, "symbols": [{"text": letter} for letter in word]} for word in words
+                    ]}]}]
+                }]
+            }))
+        return vision.BatchAnnotateImagesResponse(responses=responses)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    # The polling loop would otherwise print a line per poll
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class FakeJudge0:
+    # Judge0's batch REST API on a local port; a submission finishes after the processing latency and echoes its stdin
+    def __init__(self, processing_latency):
+        self.processing_latency = processing_latency
+        self.submissions = {}
+        self.stats = {"submitted": 0, "polls": 0}
+        self._lock = threading.Lock()
+        self._server = None
+        self.app = Flask("fake_judge0")
+        self.app.add_url_rule("/submissions/batch", "submit", self.submit, methods=["POST"])
+        self.app.add_url_rule("/submissions/batch", "results", self.results, methods=["GET"])
+
+    def finish(self, token, stdin):
+        with self._lock:
+            self.submissions[token] = {
+                "token": token,
+                "status": {"id": 3, "description": "Accepted"},
+                "stdout": stdin,
+                "stderr": None,
+                "compile_output": None,
+                "time": "0.01",
+                "memory": 3000
+            }
+
+    def submit(self):
+        tokens = []
+        for submission in request.get_json()["submissions"]:
+            token = uuid.uuid4().hex
+            with self._lock:
+                self.submissions[token] = {"token": token, "status": {"id": 1, "description": "In Queue"}}
+                self.stats["submitted"] += 1
+            delay = self.processing_latency.seconds
+            threading.Timer(delay, self.finish, (token, submission.get("stdin", ""))).start()
+            tokens.append({"token": token})
+        return jsonify(tokens), 201
+
+    def results(self):
+        with self._lock:
+            self.stats["polls"] += 1
+            submissions = [self.submissions.get(token) for token in request.args.get("tokens", "").split(",")]
+        return jsonify({"submissions": submissions})
+
+    def start(self, host="127.0.0.1", port=0):
+        self._server = make_server(host, port, self.app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def sample_pdf(title, paragraphs):
+    import fitz
+
+    document = fitz.open()
+    for number, paragraph in enumerate(paragraphs, 1):
+        page = document.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), f"{title} - Section {number}\n\n{paragraph}", fontsize=11)
+    content = document.tobytes()
+    document.close()
+    return content
+
+def sample_image(seed, size=(2400, 1800)):
+    # A noisy phone-photo-sized JPEG, so downsizing and re-encoding cost what they would on a real scan
+    from PIL import Image
+
+    pixels = np.random.default_rng(seed).integers(180, 256, size=(size[1], size[0], 3), dtype=np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(output, format="JPEG", quality=90)
+    return output.getvalue()
@@ -0,0 +1,294 @@
+# Offline load test of the grading service: boots create_app against the local fakes in benchmarks/fakes.py
+# and drives grade-answer, code-eval submit and OCR at a set concurrency.
+#
+#   python -m benchmarks.run --requests 200 --concurrency 16 --llm-latency 1.2 --output results.json
+#   python -m benchmarks.run --baseline results.json --max-regression 0.15
+#
+# Run from grading-system/. With --baseline the run fails when a scenario's p95 or throughput is worse than the
+# baseline by more than --max-regression, so it can gate changes to the hot paths.
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.fakes import (
+    Latency, HashingEmbedder, FakeGenaiClient, FakeStorageClient, FakeVisionClient, FakeJudge0, sample_pdf, sample_image
+)
+
+API_KEY = "benchmark"
+BUCKET = "benchmark-course"
+SCENARIOS = ("grade_answer", "code_eval", "ocr")
+
+TOPICS = [
+    ("Photosynthesis", "Photosynthesis converts light energy into chemical energy. Chlorophyll in the thylakoid membranes absorbs light, water is split and oxygen is released, and the Calvin cycle fixes carbon dioxide into glucose using ATP and NADPH."),
+    ("Cell Respiration", "Cellular respiration releases the energy stored in glucose. Glycolysis takes place in the cytoplasm, the Krebs cycle in the mitochondrial matrix, and oxidative phosphorylation along the inner membrane produces most of the ATP."),
+    ("Genetics", "Genes are segments of DNA that code for proteins. Alleles segregate during meiosis, dominant alleles mask recessive ones, and a Punnett square predicts the ratios of genotypes among offspring."),
+    ("Ecology", "Energy flows through an ecosystem from producers to consumers, with roughly ten percent passed on at each trophic level. Decomposers return nutrients to the soil and complete the carbon and nitrogen cycles."),
+]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the grading service with fake Gemini, Judge0, GCS and Vision")
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--corpus", help="directory of course PDFs to serve as the bucket; a small synthetic course by default")
+    parser.add_argument("--pages", type=int, default=40, help="pages per synthetic PDF")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="seconds per Gemini call")
+    parser.add_argument("--llm-seconds-per-1k-tokens", type=float, default=0.05, help="extra Gemini latency per 1000 prompt tokens")
+    parser.add_argument("--judge0-latency", type=float, default=0.5, help="seconds until a Judge0 submission finishes")
+    parser.add_argument("--vision-latency", type=float, default=0.6, help="seconds per Vision batch call")
+    parser.add_argument("--gcs-latency", type=float, default=0.05, help="seconds per GCS listing and per MB downloaded")
+    parser.add_argument("--context-cache-min-tokens", type=int, default=4096,
+                        help="smallest prompt prefix sent as Gemini cached content; lower it to exercise caching on a small course")
+    parser.add_argument("--test-cases", type=int, default=5, help="test cases per code submission")
+    parser.add_argument("--cache-hits", action="store_true", help="repeat the same inputs so the LLM and OCR caches answer")
+    parser.add_argument("--real-embedder", action="store_true", help="load the sentence-transformers model instead of the hashing stand-in")
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="allowed fractional slowdown against the baseline")
+    return parser.parse_args(argv)
+
+def configure_environment(workdir, judge0_url, args):
+    # Every cache and queue lives in the run's own directory, so runs start cold and leave nothing behind
+    os.environ.update({
+        "GRADIA_API_KEY": API_KEY,
+        "JUDGE0_URL": judge0_url,
+        "CODE_EXECUTOR": "judge0",
+        "INDEX_CACHE_DIR": os.path.join(workdir, "index-cache"),
+        "TEXT_CACHE_DIR": os.path.join(workdir, "text-cache"),
+        "EMBEDDING_CACHE_DIR": os.path.join(workdir, "embedding-cache"),
+        "BLOB_CACHE_DIR": os.path.join(workdir, "blob-cache"),
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm-cache.sqlite3"),
+        "OCR_CACHE_PATH": os.path.join(workdir, "ocr-cache.sqlite3"),
+        "JOBS_DB_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "PREPARED_QUESTIONS_PATH": os.path.join(workdir, "prepared-questions.sqlite3"),
+        "CONTEXT_CACHE_PATH": os.path.join(workdir, "context-cache.sqlite3"),
+        "CONTEXT_CACHE_MIN_TOKENS": str(args.context_cache_min_tokens),
+    })
+
+def prepare_bucket(root, corpus, pages):
+    bucket_dir = os.path.join(root, BUCKET)
+    os.makedirs(bucket_dir)
+    if corpus:
+        for name in sorted(os.listdir(corpus)):
+            if name.endswith(".pdf"):
+                shutil.copy(os.path.join(corpus, name), bucket_dir)
+        return
+    for title, paragraph in TOPICS:
+        content = sample_pdf(title, [f"{paragraph} (Part {page}.)" for page in range(1, pages + 1)])
+        with open(os.path.join(bucket_dir, f"{title.lower().replace(' ', '_')}.pdf"), "wb") as file:
+            file.write(content)
+
+def install_fakes(args, storage_root):
+    from app.services import providers
+
+    providers.genai_client.factory = lambda: FakeGenaiClient(
+        Latency(args.llm_latency), args.llm_seconds_per_1k_tokens, args.context_cache_min_tokens
+    )
+    providers.storage_client.factory = lambda: FakeStorageClient(storage_root, Latency(args.gcs_latency), Latency(args.gcs_latency))
+    providers.vision_client.factory = lambda: FakeVisionClient(Latency(args.vision_latency))
+    if not args.real_embedder:
+        providers.embedder.factory = HashingEmbedder
+
+def grade_answer_request(index, args):
+    title, paragraph = TOPICS[index % len(TOPICS)]
+    answer = paragraph if args.cache_hits else f"{paragraph} Student {index} adds their own example."
+    return "post", "/api/grading/grade-answer", {"json": {
+        "question": f"Explain {title.lower()} and the main steps involved.",
+        "student_answer": answer,
+        "max_mark": 5,
+        "bucket_name": BUCKET,
+        "rubrics": ["Names the main stages", "Explains where each takes place"]
+    }}
+
+def code_eval_request(index, args):
+    seed = 0 if args.cache_hits else index
+    return "post", "/api/code-eval/submit", {"json": {
+        "source_code": "def solution(value):\n    return value",
+        "language": "python3",
+        "test_cases": [{"input": f"{seed}-{case}", "expected_output": f"{seed}-{case}"} for case in range(args.test_cases)]
+    }}
+
+def ocr_request_factory(args):
+    # A few phone-sized scans, made distinct per request by trailing bytes the decoder ignores
+    images = [sample_image(seed) for seed in range(4)]
+
+    def ocr_request(index, args):
+        content = images[index % len(images)]
+        if not args.cache_hits:
+            content += f"\n{index}".encode("ascii")
+        return "post", "/api/ocr/extract-text", {"data": {"file": (io.BytesIO(content), f"page-{index}.jpg")}, "content_type": "multipart/form-data"}
+
+    return ocr_request
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def stage_snapshot():
+    from app.utils.metrics import metrics
+
+    with metrics._lock:
+        return {
+            dict(labels)["stage"]: (histogram["sum"], histogram["count"])
+            for (name, labels), histogram in metrics.histograms.items()
+            if name == "gradia_stage_seconds"
+        }
+
+def llm_usage():
+    from app.services.llm_client import llm_client
+
+    return dict(llm_client.usage)
+
+def stage_breakdown(before, after):
+    stages = {}
+    for name, (total, count) in sorted(after.items()):
+        previous_total, previous_count = before.get(name, (0.0, 0))
+        calls = count - previous_count
+        if calls:
+            stages[name] = {"calls": calls, "mean_ms": round((total - previous_total) / calls * 1000, 1)}
+    return stages
+
+def run_scenario(app, name, build_request, args):
+    thread_state = threading.local()
+
+    def send(index):
+        client = getattr(thread_state, "client", None)
+        if client is None:
+            client = thread_state.client = app.test_client()
+        method, path, kwargs = build_request(index, args)
+        started = time.perf_counter()
+        response = getattr(client, method)(path, headers={"X-API-Key": API_KEY}, **kwargs)
+        return time.perf_counter() - started, response.status_code
+
+    before = stage_snapshot()
+    usage_before = llm_usage()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = np.array([latency for latency, _ in outcomes]) * 1000
+    return {
+        "requests": len(outcomes),
+        "errors": sum(1 for _, status in outcomes if status >= 400),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+        "throughput_rps": round(len(outcomes) / elapsed, 2),
+        "rss_mb": current_rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stage_breakdown(before, stage_snapshot()),
+        "llm_tokens": {key: value - usage_before[key] for key, value in llm_usage().items()}
+    }
+
+def warm_up(app, args):
+    # The first grade builds the bucket's index; timed on its own so it does not skew the scenario's percentiles
+    client = app.test_client()
+    before = stage_snapshot()
+    started = time.perf_counter()
+    method, path, kwargs = grade_answer_request(-1, args)
+    response = getattr(client, method)(path, headers={"X-API-Key": API_KEY}, **kwargs)
+    return {
+        "status": response.status_code,
+        "seconds": round(time.perf_counter() - started, 3),
+        "rss_mb": current_rss_mb(),
+        "stages": stage_breakdown(before, stage_snapshot())
+    }
+
+def print_report(results):
+    cold = results["index_build"]
+    print(f"\nIndex build (first grade-answer): {cold['seconds']}s, status {cold['status']}, RSS {cold['rss_mb']} MB")
+    print(f"\n{'scenario':<14}{'reqs':>6}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'RSS MB':>9}")
+    for name, result in results["scenarios"].items():
+        print(f"{name:<14}{result['requests']:>6}{result['errors']:>8}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+              f"{result['p99_ms']:>10}{result['throughput_rps']:>9}{result['rss_mb']:>9}")
+    for name, result in results["scenarios"].items():
+        tokens = result["llm_tokens"]
+        print(f"\n{name}: {tokens['requests']} Gemini calls, {tokens['prompt_tokens']} prompt tokens "
+              f"({tokens['cached_tokens']} from cached content), {tokens['output_tokens']} output tokens")
+        print(f"{name} stages:")
+        for stage_name, stage in result["stages"].items():
+            print(f"  {stage_name:<22}{stage['calls']:>6} calls {stage['mean_ms']:>10} ms mean")
+
+def regressions(results, baseline, max_regression):
+    found = []
+    for name, result in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        if result["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            found.append(f"{name}: p95 {result['p95_ms']} ms vs {previous['p95_ms']} ms")
+        if result["throughput_rps"] < previous["throughput_rps"] * (1 - max_regression):
+            found.append(f"{name}: throughput {result['throughput_rps']} req/s vs {previous['throughput_rps']} req/s")
+    return found
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}")
+
+    workdir = tempfile.mkdtemp(prefix="gradia-benchmark-")
+    judge0 = FakeJudge0(Latency(args.judge0_latency))
+    try:
+        configure_environment(workdir, judge0.start(), args)
+        storage_root = os.path.join(workdir, "buckets")
+        prepare_bucket(storage_root, args.corpus, args.pages)
+
+        # Imported only now: services read their settings from the environment at import time
+        install_fakes(args, storage_root)
+        from app import create_app
+        app = create_app()
+
+        builders = {"grade_answer": grade_answer_request, "code_eval": code_eval_request}
+        if "ocr" in scenarios:
+            builders["ocr"] = ocr_request_factory(args)
+
+        results = {
+            "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+            "index_build": warm_up(app, args),
+            "scenarios": {}
+        }
+        for name in scenarios:
+            print(f"Running {name}: {args.requests} requests at concurrency {args.concurrency}")
+            results["scenarios"][name] = run_scenario(app, name, builders[name], args)
+    finally:
+        judge0.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(results, json.load(file), args.max_regression)
+        if found:
+            print("\nRegressions against the baseline:\n  " + "\n  ".join(found))
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
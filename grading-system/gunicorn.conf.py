@@ -0,0 +1,13 @@
+import os
+
+bind = "0.0.0.0:8080"
+timeout = 180
+threads = 8
+# With PRELOAD_MODELS=true the app, and the embedding model with it, is loaded once in the master
+# and shared copy-on-write by the forked workers; network clients are still created per worker.
+preload_app = os.getenv("PRELOAD_MODELS", "false").lower() == "true"
+
+def post_fork(server, worker):
+    # Sandbox processes are per worker: started after the fork, never in the master, so their pipes are not shared
+    from app.services.code_eval_service import warm_up_executor
+    warm_up_executor()
@@ -0,0 +1,33 @@
+from app.services.chunking import chunk_pages, estimate_tokens
+
+def embedding_tokens(chunk):
+    return estimate_tokens(f"{chunk['heading']}\n{chunk['text']}" if chunk["heading"] else chunk["text"])
+
+def long_sentence(number, words):
+    return f"Sentence {number} " + " ".join(f"word{number}x{i}" for i in range(words)) + "."
+
+def test_chunks_stay_within_max_tokens_with_overlap_and_heading():
+    # Short sentences before one close to the budget put the overlap tail in front of it
+    paragraphs = [" ".join(long_sentence(i, words) for i, words in enumerate([8, 8, 225, 8, 8, 220, 40, 2, 200, 15, 60]))]
+    page = "CHAPTER 4: MEMORY MANAGEMENT AND PAGING\n\n" + "\n\n".join(paragraphs)
+    chunks = list(chunk_pages([(1, page), (2, paragraphs[0])], "notes.pdf", max_tokens=240, overlap_tokens=32))
+
+    assert len(chunks) > 2
+    assert any(chunk["heading"] for chunk in chunks)
+    for chunk in chunks:
+        assert embedding_tokens(chunk) <= 240
+
+def test_overlap_repeats_the_end_of_the_previous_chunk():
+    text = " ".join(long_sentence(i, 20) for i in range(12))
+    chunks = list(chunk_pages([(1, text)], "notes.pdf", max_tokens=120, overlap_tokens=40))
+
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk["text"].split(". ")[0] in previous["text"]
+        assert embedding_tokens(chunk) <= 120
+
+def test_sentences_longer_than_the_budget_are_split():
+    chunks = list(chunk_pages([(1, long_sentence(0, 600))], "notes.pdf", max_tokens=100, overlap_tokens=20))
+
+    assert len(chunks) > 1
+    assert all(embedding_tokens(chunk) <= 100 for chunk in chunks)
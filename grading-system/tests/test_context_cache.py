@@ -0,0 +1,29 @@
+from benchmarks.fakes import FakeGenaiClient, Latency
+from app.services import grading_service, providers
+from app.services.chunking import chunk_pages
+from app.services.context_cache import context_cache
+from app.utils.sqlite_cache import SqliteCache
+
+def course_chunks(count):
+    # Lecture notes cut by the default chunker, retrieved best first
+    sentences = [
+        f"Scheduling policy {i} decides which ready process runs next, trading throughput against response time for interactive workloads."
+        for i in range(400)
+    ]
+    pages = [(page + 1, " ".join(sentences[page * 40:(page + 1) * 40])) for page in range(10)]
+    chunks = list(chunk_pages(pages, "os-notes.pdf"))[:count]
+    return [{**chunk, "score": round(0.8 - position * 0.01, 4)} for position, chunk in enumerate(chunks)]
+
+def test_retrieved_references_reach_the_default_cache_minimum(tmp_path, monkeypatch):
+    fake = FakeGenaiClient(Latency(0))
+    monkeypatch.setattr(providers.genai_client, "_instance", fake)
+    monkeypatch.setattr(context_cache, "store", SqliteCache(str(tmp_path / "context.sqlite3"), 3600, 100))
+
+    references = course_chunks(grading_service.RETRIEVAL_K)
+    for answer in ("Round robin gives each process a time slice.", "FCFS runs processes in arrival order."):
+        grading_service.grade_answer("Compare CPU scheduling policies", answer, 5, "course", references=references, force=True)
+
+    # One upload for the question, then the second answer is graded against the cached prefix
+    assert fake.caches.stats["created"] == 1
+    assert len(fake.caches.entries) == 1
+    assert context_cache.stats()["hits"] >= 1
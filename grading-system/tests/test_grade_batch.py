@@ -0,0 +1,19 @@
+from app.services import grading_service
+from app.services.llm_client import LLMUnavailableError
+
+def coding_item(question):
+    return {"type": "coding", "question": question, "student_code": "print(1)", "max_mark": 5}
+
+def test_unavailable_llm_fails_only_its_own_items(monkeypatch):
+    def grade_code(question, student_code, max_mark, force=False):
+        if question == "Q2":
+            raise LLMUnavailableError("Gemini is unavailable", 12.4)
+        return {"grade": 4, "feedback": "Good"}
+
+    monkeypatch.setattr(grading_service, "grade_code", grade_code)
+    results = grading_service.grade_batch("course", [coding_item("Q1"), coding_item("Q2"), coding_item("Q3")], pack=False)
+
+    assert results[0] == {"grade": 4, "feedback": "Good"}
+    assert results[2] == {"grade": 4, "feedback": "Good"}
+    assert results[1]["error"] == "Gemini is unavailable"
+    assert results[1]["retry_after"] == 12
@@ -0,0 +1,14 @@
+from app.services.prepared_questions import PreparedQuestions
+from app.utils.sqlite_cache import SqliteCache
+
+def make_store(tmp_path):
+    return PreparedQuestions(SqliteCache(str(tmp_path / "prepared.sqlite3"), 3600, 100))
+
+def test_entry_is_reused_only_for_the_listing_it_was_retrieved_from(tmp_path):
+    prepared = make_store(tmp_path)
+    prepared.put("course", "q1", "Explain paging", "listing-a", [{"text": "Pages are fixed-size blocks."}])
+
+    assert prepared.get("course", "q1", "Explain paging", "listing-a")["references"] == [{"text": "Pages are fixed-size blocks."}]
+    # Material uploaded through another host, or straight to the bucket, changes the listing
+    assert prepared.get("course", "q1", "Explain paging", "listing-b") is None
+    assert prepared.get("course", "q1", "Explain segmentation", "listing-a") is None